@@ -0,0 +1,139 @@
+"""
+Benchmark of utils.noise.PerlinNoise
+Usage: python -m bench.noise [-o result.json] [--compare base.json] [--threshold 0.2]
+"""
+
+import argparse
+import itertools
+import json
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+# Side length of each dim
+SIZES: Dict[int, List[int]] = {1: [4096, 65536], 2: [128, 512], 3: [32, 64], 4: [12, 20]}
+DETAILS: List[int] = [1, 4]
+SCALES: List[float] = [1.0, 4.0]
+REPEATS: List[bool] = [False, True]
+OPS: List[str] = ['init', 'reseed', 'generate', 'generate_all']
+KEYS: Tuple[str, ...] = ('dim', 'size', 'detail', 'scale', 'repeat', 'op')
+
+
+def _timeit(func: Callable, rounds: int) -> Tuple[float, int]:
+    """Best wall time of several rounds, and peak traced allocation of one round."""
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    alloc_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, alloc_peak
+
+
+def run_case(dim: int, size: int, detail: int, scale: float, repeat: bool, rounds: int) -> List[dict]:
+    """Run all ops of one case, should be called in a fresh process."""
+    from utils.noise import PerlinNoise
+    rss_base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    shape = [size] * dim
+    noise = PerlinNoise(shape, scale=scale, detail=detail, seed=0)
+    grid = np.mgrid[tuple(slice(_) for _ in shape)]
+    ops = {
+        'init': lambda: PerlinNoise(shape, scale=scale, detail=detail, seed=0),
+        'reseed': lambda: noise.reseed(1),
+        'generate': lambda: noise.generate(grid, repeat=repeat),
+        'generate_all': lambda: noise.generate_all()
+    }
+    output = []
+    for op in OPS:
+        wall, alloc_peak = _timeit(ops[op], rounds)
+        output.append({
+            'dim': dim, 'size': size, 'detail': detail, 'scale': scale, 'repeat': repeat, 'op': op,
+            'time': wall,
+            'alloc_peak': alloc_peak,
+            # KiB on Linux
+            'rss_peak': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_base) * 1024
+        })
+    return output
+
+
+def _commit() -> str:
+    process = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True)
+    return process.stdout.decode().strip() if process.returncode == 0 else ''
+
+
+def run_all(dims: List[int], rounds: int) -> dict:
+    results = []
+    context = get_context('spawn')
+    for dim in dims:
+        for size, detail, scale, repeat in itertools.product(SIZES[dim], DETAILS, SCALES, REPEATS):
+            # Fresh process for each case, so peak RSS is not shared
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                output = executor.submit(run_case, dim, size, detail, scale, repeat, rounds).result()
+            for item in output:
+                print('{dim}D size={size} detail={detail} scale={scale} repeat={repeat} {op}: '
+                      '{time:.6f}s alloc={alloc_peak}B rss={rss_peak}B'.format(**item))
+            results.extend(output)
+    return {
+        'meta': {
+            'commit': _commit(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'time': int(time.time())
+        },
+        'results': results
+    }
+
+
+def compare(base: dict, current: dict, threshold: float) -> List[str]:
+    """List regressions of time or allocation larger than threshold (ratio)."""
+    base_map = {tuple(_[k] for k in KEYS): _ for _ in base['results']}
+    regressions = []
+    for item in current['results']:
+        old = base_map.get(tuple(item[k] for k in KEYS))
+        if old is None:
+            continue
+        for metric in 'time', 'alloc_peak':
+            if old[metric] > 0 and item[metric] > old[metric] * (1 + threshold):
+                regressions.append('{} {}: {} -> {} (+{:.1%})'.format(
+                    ' '.join(f'{k}={item[k]}' for k in KEYS), metric,
+                    old[metric], item[metric], item[metric] / old[metric] - 1
+                ))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of PerlinNoise.')
+    parser.add_argument('-o', '--output', help='write results to a JSON file')
+    parser.add_argument('--dims', type=int, nargs='+', default=sorted(SIZES), choices=sorted(SIZES))
+    parser.add_argument('--rounds', type=int, default=3, help='rounds for each op (best is kept)')
+    parser.add_argument('--compare', help='JSON results of the base commit')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown ratio')
+    args = parser.parse_args()
+
+    current = run_all(args.dims, args.rounds)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), current, args.threshold)
+        for line in regressions:
+            print(f'[REGRESSION] {line}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
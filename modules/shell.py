@@ -1,20 +1,20 @@
-# import asyncio
+import asyncio
 from typing import Union
 
 from arclet.alconna import Alconna, Args, Option, Arpamar
 from arclet.alconna.graia import AlconnaDispatcher
 from graia.ariadne.app import Ariadne
+from graia.ariadne.event.lifecycle import ApplicationLaunched, ApplicationShutdowned
 from graia.ariadne.event.message import GroupMessage
 from graia.ariadne.message.chain import MessageChain
-# from graia.ariadne.message.element import At
+from graia.ariadne.message.element import At
 from graia.ariadne.model import Group, Member
-from graia.ariadne.util.async_exec import io_bound
 from graia.broadcast.interrupt import InterruptControl
 from graia.broadcast.interrupt.waiter import Waiter
 from graia.saya import Channel, Saya
 from graia.saya.builtins.broadcast.schema import ListenerSchema
 
-from utils.shell import single_cmd, Shell  # , TIMEOUT, CompletedProcess
+from utils.shell import QueueFullError, SessionLimitError, SESSION_TTL, TIMEOUT, pool, scheduler, sessions, stream_cmd
 
 channel = Channel.current()
 
@@ -27,10 +27,13 @@ command = Alconna(
     command='sh',
     options=[
         Option('--command|-c', Args['cmd;S': str]),
+        Option('--stream|-s', Args['cmd;S': str]),
         Option('--env', Args['args;W': str])
     ]
 )
 inc = InterruptControl(Saya.current().broadcast)
+# Members talking to their interactive shells
+attached = set()
 
 
 class InteractiveShellWaiter(Waiter.create([GroupMessage])):
@@ -45,48 +48,15 @@ class InteractiveShellWaiter(Waiter.create([GroupMessage])):
             return message
 
 
-@io_bound
-def async_single_cmd(cmd: str):
-    """Run single command."""
-    return single_cmd(cmd)
+@channel.use(ListenerSchema(listening_events=[ApplicationLaunched]))
+async def shell_launched():
+    # Warm shells before the first /sh -c
+    await pool.start()
 
 
-class AsyncShell(object):
-    """Define an interactive shell."""
-    shell: Shell
-
-    def __init__(self, name: str = None):
-        self.shell = Shell(name)
-
-    @io_bound
-    def kill(self):
-        """Kill all processes called by current shell."""
-        return self.shell.kill()
-
-    @io_bound
-    def start(self, env: dict = None):
-        """Start the shell."""
-        return self.shell.start(env)
-
-    @io_bound
-    def send(self, text: str):
-        """Send command(s) to the shell."""
-        return self.shell.send(text)
-
-    @io_bound
-    def exit(self):
-        """Gracefully close the shell."""
-        return self.shell.exit()
-
-    @property
-    def name(self) -> str:
-        """The shell name."""
-        return self.shell.name
-
-    @property
-    def enabled(self) -> bool:
-        """Check if the shell is running."""
-        return self.shell.enabled
+@channel.use(ListenerSchema(listening_events=[ApplicationShutdowned]))
+async def shell_shutdowned():
+    await pool.close()
 
 
 @channel.use(ListenerSchema(
@@ -95,38 +65,63 @@ class AsyncShell(object):
 ))
 async def shell_group_listener(app: Ariadne,
                                group: Group,
-                               # member: Member,
+                               member: Member,
                                message: MessageChain,
                                result: Arpamar):
-    # env: dict = result.options.get('env', {}).get('args', None)
+    env: dict = result.options.get('env', {}).get('args', None)
     cmd: tuple = result.options.get('command', {}).get('cmd', None)
-    if cmd is None:
-        await app.sendMessage(group, MessageChain(command.help_text), quote=message)
-        # The interactive shell is disabled due to technical issues.
-        # shell = AsyncShell(str(member.id))
-        # await shell.start(env)
-        # return_msg = MessageChain('===已建立交互式终端===')
-        # last_quote = message
-        # while shell.enabled:
-        #     await app.sendMessage(group, return_msg, quote=last_quote)
-        #     try:
-        #         message: MessageChain = await inc.wait(
-        #             InteractiveShellWaiter(group, member),
-        #             timeout=TIMEOUT * 5
-        #         )
-        #     except asyncio.TimeoutError:
-        #         await shell.exit()
-        #         return_msg = MessageChain([At(member), '\n响应超时，终端已关闭。'])
-        #         last_quote = False
-        #     else:
-        #         process: CompletedProcess = await shell.send(message.asDisplay())
-        #         return_msg = MessageChain(process.as_string())
-        #         last_quote = message
-        # if last_quote:
-        #     return_msg.append('\n终端已关闭。')
-        # await app.sendMessage(group, return_msg, quote=last_quote)
+    stream: tuple = result.options.get('stream', {}).get('cmd', None)
+    if stream:
+        # Send output while the command is running
+        try:
+            async with scheduler.slot(group.id, member.id):
+                async for output in stream_cmd(' '.join(stream)):
+                    await app.sendMessage(group, MessageChain(output), quote=message)
+        except QueueFullError:
+            await app.sendMessage(group, MessageChain('排队中的命令过多，请稍后再试。'), quote=message)
+    elif cmd is None:
+        key = (group.id, member.id)
+        if key in attached:
+            return
+        try:
+            await sessions.open(group.id, member.id, env)
+        except SessionLimitError:
+            await app.sendMessage(group, MessageChain('交互式终端数量已达上限，请稍后再试。'), quote=message)
+            return
+        attached.add(key)
+        return_msg = MessageChain('===已连接交互式终端===')
+        last_quote = message
+        try:
+            while key in sessions:
+                await app.sendMessage(group, return_msg, quote=last_quote)
+                try:
+                    message: MessageChain = await inc.wait(
+                        InteractiveShellWaiter(group, member),
+                        timeout=TIMEOUT * 5
+                    )
+                except asyncio.TimeoutError:
+                    return_msg = MessageChain([At(member), f'\n响应超时，已断开终端，终端将在闲置{SESSION_TTL}秒后关闭。'])
+                    last_quote = False
+                    break
+                try:
+                    process = await scheduler.run(group.id, member.id, sessions.send, group.id, member.id,
+                                                  message.asDisplay())
+                except QueueFullError:
+                    return_msg = MessageChain('排队中的命令过多，请稍后再试。')
+                else:
+                    return_msg = MessageChain(process.as_string())
+                last_quote = message
+            else:
+                return_msg.append('\n终端已关闭。')
+        finally:
+            attached.discard(key)
+        await app.sendMessage(group, return_msg, quote=last_quote)
     elif cmd:
-        process = await async_single_cmd(' '.join(cmd))
-        await app.sendMessage(group, MessageChain(process.as_string()), quote=message)
+        try:
+            process = await scheduler.run(group.id, member.id, pool.run, ' '.join(cmd))
+        except QueueFullError:
+            await app.sendMessage(group, MessageChain('排队中的命令过多，请稍后再试。'), quote=message)
+        else:
+            await app.sendMessage(group, MessageChain(process.as_string()), quote=message)
     else:
         await app.sendMessage(group, MessageChain('???'), quote=message)
@@ -8,14 +8,53 @@ from ..model import QiModel, validator
 class ShellConfigModel(QiModel):
     timeout: Union[int, float] = 30
     shell_exec: Union[List[str], str] = ['bash']
-    check_dir: str = 'tmp/shell'
     output_replace: Dict[str, str] = {}
+    stream_interval: Union[int, float] = 3
+    stream_size: int = 2000
+    stream_limit: int = 20000
+    output_limit: int = 65536
+    workers: int = 2
+    group_queue: int = 4
+    member_queue: int = 2
+    pool_size: int = 2
+    pool_recycle: int = 100
+    session_ttl: Union[int, float] = 600
+    session_limit: int = 8
+    limit_cpu: int = 0
+    limit_memory: int = 0
+    limit_files: int = 0
+    limit_output: int = 0
 
     # noinspection PyMethodParameters
     @validator('timeout')
     def __timeout(cls, v):
         return v if v > 5 else 5
 
+    # noinspection PyMethodParameters
+    @validator('stream_interval')
+    def __stream_interval(cls, v):
+        return v if v > 0.5 else 0.5
+
+    # noinspection PyMethodParameters
+    @validator('stream_size', 'stream_limit', 'output_limit')
+    def __stream_size(cls, v):
+        return v if v > 100 else 100
+
+    # noinspection PyMethodParameters
+    @validator('workers', 'group_queue', 'member_queue', 'pool_size', 'pool_recycle', 'session_limit')
+    def __workers(cls, v):
+        return v if v > 1 else 1
+
+    # noinspection PyMethodParameters
+    @validator('session_ttl')
+    def __session_ttl(cls, v):
+        return v if v > 30 else 30
+
+    # noinspection PyMethodParameters
+    @validator('limit_cpu', 'limit_memory', 'limit_files', 'limit_output')
+    def __limit(cls, v):
+        return v if v > 0 else 0
+
     # noinspection PyMethodParameters
     @validator('shell_exec')
     def __shell_exec(cls, v):
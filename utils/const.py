@@ -4,7 +4,22 @@ from typing import List
 class FILE:
     CACHE_ENABLE: bool = True
     NEWLINE: bool = True
+    # Size quota of cache/, 'lru' or 'lfu' eviction
+    CACHE_QUOTA: int = 512 * 1024 * 1024
+    CACHE_POLICY: str = 'lru'
+    CACHE_COMPACT_INTERVAL: float = 600
+
+
+class NOISE:
+    CACHE_LIMIT: int = 64 * 1024 * 1024
 
 
 class TTS:
     LANGUAGES: List[str] = ['zh', 'cmn']
+    MEMORY_LIMIT: int = 16 * 1024 * 1024
+
+
+class HTTP:
+    POOL_SIZE: int = 4
+    IDLE_TIMEOUT: float = 30
+    TIMEOUT: float = 10
@@ -1,5 +1,6 @@
 from .error import DataCheckError, _import_warning
-from .types import CommonFile, DataFile, ConfigFile, Cache, Data, Config
+from .manager import CacheManager, cache_manager
+from .types import CommonFile, DataFile, ConfigFile, Cache, Data, Config, MemoryCache
 
 # Must import after .types
 from .json import JsonMixin, JsonConfig, JsonData
@@ -0,0 +1,208 @@
+import atexit
+import json
+import os
+import threading
+from pathlib import Path
+from time import time
+from typing import Dict, List, Optional
+
+from ..const import FILE
+from ..logger import logger
+
+CACHE_QUOTA = FILE.CACHE_QUOTA
+CACHE_POLICY = FILE.CACHE_POLICY
+CACHE_COMPACT_INTERVAL = FILE.CACHE_COMPACT_INTERVAL
+
+
+def shard(filename: str) -> str:
+    """Sub directory of a cache file, by the prefix of its (hash) filename."""
+    return filename[:2]
+
+
+class CacheManager(object):
+    """
+    Cache Directory Manager
+    Index: cache/.index.json, {path: [size, last access, hits]}
+    Files are evicted by LRU/LFU when exceeding the quota
+    """
+    _index: Dict[str, List]
+    _thread: Optional[threading.Thread] = None
+
+    def __init__(self,
+                 root: Path = Path('cache'),
+                 quota: int = CACHE_QUOTA,
+                 policy: str = CACHE_POLICY,
+                 interval: float = CACHE_COMPACT_INTERVAL):
+        if policy not in ('lru', 'lfu'):
+            raise ValueError(f'Unknown cache policy: {policy}')
+        self.root = root
+        self.quota = quota
+        self.policy = policy
+        self.interval = interval
+        self.size = 0
+        self._index = {}
+        self._loaded = False
+        self._dirty = False
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+
+    @property
+    def index_path(self) -> Path:
+        return self.root / '.index.json'
+
+    def _key(self, path: Path) -> str:
+        return path.relative_to(self.root).as_posix()
+
+    def _read_index(self) -> None:
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            self._index = json.loads(self.index_path.read_text())
+        except (OSError, ValueError):
+            # Lost or broken, rebuilt by compaction
+            self._index = {}
+        self.size = sum(_[0] for _ in self._index.values())
+
+    def _load(self) -> None:
+        if not self._loaded:
+            self._read_index()
+            self.start()
+
+    def save(self) -> None:
+        """Write the index if changed."""
+        with self._lock:
+            if not self._dirty:
+                return
+            self.root.mkdir(mode=0o755, parents=True, exist_ok=True)
+            temp_path = self.index_path.with_suffix(f'.{os.getpid()}.tmp')
+            temp_path.write_text(json.dumps(self._index))
+            temp_path.replace(self.index_path)
+            self._dirty = False
+
+    def add(self, path: Path, size: int = None) -> None:
+        """Record a written file, evict others if exceeding the quota."""
+        with self._lock:
+            self._load()
+            if size is None:
+                size = path.stat().st_size
+            key = self._key(path)
+            hits = self._index[key][2] if key in self._index else 0
+            self._remove(key)
+            self._index[key] = [size, time(), hits]
+            self.size += size
+            self._dirty = True
+            if self.size > self.quota:
+                # A new file has no hits, never evict it at once
+                self.evict(key)
+
+    def hit(self, path: Path) -> None:
+        """Record an access."""
+        with self._lock:
+            self._load()
+            entry = self._index.get(self._key(path))
+            if entry is None:
+                try:
+                    self.add(path)
+                except OSError:
+                    pass
+                return
+            entry[1] = time()
+            entry[2] += 1
+            self._dirty = True
+
+    def _remove(self, key: str) -> None:
+        entry = self._index.pop(key, None)
+        if entry is not None:
+            self.size -= entry[0]
+            self._dirty = True
+
+    def remove(self, path: Path) -> None:
+        """Forget a deleted file."""
+        with self._lock:
+            self._load()
+            self._remove(self._key(path))
+
+    def evict(self, keep: str = None) -> None:
+        """Delete files (except `keep`) until the total size is within the quota."""
+        with self._lock:
+            if self.size <= self.quota:
+                return
+            if self.policy == 'lfu':
+                order = sorted(self._index, key=lambda x: (self._index[x][2], self._index[x][1]))
+            else:
+                order = sorted(self._index, key=lambda x: self._index[x][1])
+            for key in order:
+                if self.size <= self.quota:
+                    break
+                if key == keep:
+                    continue
+                (self.root / key).unlink(True)
+                self._remove(key)
+                logger.debug(f'Evict cache {key}.')
+
+    def compact(self) -> None:
+        """
+        Rebuild the index from files (keep access records),
+        move unsharded files into shards, evict and save
+        """
+        start = time()
+        files = {}
+        for category in (self.root.iterdir() if self.root.is_dir() else ()):
+            if not category.is_dir():
+                continue
+            for path in list(category.rglob('*')):
+                if not path.is_file() or path.suffix == '.tmp':
+                    continue
+                if path.parent == category:
+                    # Written before sharding
+                    target = category / shard(path.name) / path.name
+                    target.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+                    path.replace(target)
+                    path = target
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                files[self._key(path)] = stat
+        with self._lock:
+            self._read_index()
+            index = {}
+            for key, stat in files.items():
+                entry = self._index.get(key)
+                index[key] = [stat.st_size, entry[1] if entry else stat.st_mtime, entry[2] if entry else 0]
+            # Keep files recorded during scanning
+            for key, entry in self._index.items():
+                if key not in index and entry[1] >= start:
+                    index[key] = entry
+            self._dirty = self._dirty or index != self._index
+            self._index = index
+            self.size = sum(_[0] for _ in index.values())
+            self.evict()
+            self.save()
+
+    def _compact_forever(self) -> None:
+        while True:
+            try:
+                self.compact()
+            except OSError as e:
+                logger.warning(f'Failed to compact cache: {e}')
+            if self._stop.wait(self.interval):
+                break
+
+    def start(self) -> None:
+        """Start the background compaction."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._compact_forever, name='cache-compact', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self) -> None:
+        """Stop the background compaction and save the index."""
+        self._stop.set()
+        self.save()
+
+
+cache_manager = CacheManager()
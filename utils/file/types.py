@@ -1,8 +1,13 @@
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
 from functools import wraps
 from pathlib import Path
-from typing import Any, Union, Callable, Optional
+from typing import Any, Union, Callable, ClassVar, Dict, Optional, Tuple
 
 from .error import DataCheckError
+from .manager import cache_manager, shard
 from ..const import FILE
 from ..hash import hash_encode
 from ..model import QiModel, validator
@@ -11,6 +16,29 @@ CACHE_ENABLE = FILE.CACHE_ENABLE
 NEWLINE = FILE.NEWLINE
 
 
+# In-flight executor calls by file path, shared by threads and tasks
+_flights: Dict[str, Future] = {}
+_flights_lock = threading.Lock()
+# Returned by _read() when no data
+_MISSING = object()
+
+
+def _join_flight(key: str) -> Tuple[Future, bool]:
+    """Get the in-flight call of a key, return it and if the caller should lead."""
+    with _flights_lock:
+        future = _flights.get(key)
+        if future is not None:
+            return future, False
+        future = _flights[key] = Future()
+        return future, True
+
+
+def _land_flight(key: str, future: Future) -> None:
+    with _flights_lock:
+        if _flights.get(key) is future:
+            del _flights[key]
+
+
 def _get_first_arg(items) -> Union[str, bytes]:
     output = None
     for item in items:
@@ -108,32 +136,148 @@ class DataFile(CommonFile):
 
     def executor(self, read: bool = True, write: bool = True) -> Callable:
         def __func(func: Callable) -> Callable:
-            @wraps(func)
-            def __wrapper(*args, **kwargs) -> Any:
+            def __prepare(args: tuple, kwargs: dict) -> 'DataFile':
+                # The decorator is shared by threads and tasks, work on a copy
+                target = self.copy()
                 # Pre-process function
-                self._exec_pre(*args, **kwargs)
+                target._exec_pre(*args, **kwargs)
+                return target
+
+            def __read(target: 'DataFile') -> Any:
                 # Read data, continue when failed
                 # Note: No check if succeed
                 if read:
                     try:
-                        return self.read()
+                        return target.read()
                     except DataCheckError:
                         pass
-                # Execute function
-                output = func(*args, **kwargs)
+                return _MISSING
+
+            def __finish(target: 'DataFile', output: Any, args: tuple, kwargs: dict) -> Any:
                 # After-process function
-                output = self._exec_post(output, args, kwargs)
+                output = target._exec_post(output, args, kwargs)
                 # Write data and return
                 if write:
-                    self.write(output)
+                    target.write(output)
                 return output
 
+            if asyncio.iscoroutinefunction(func):
+                @wraps(func)
+                async def __async_wrapper(*args, **kwargs) -> Any:
+                    target = __prepare(args, kwargs)
+                    output = __read(target)
+                    if output is not _MISSING:
+                        return output
+                    # Single flight: wait for the same call running elsewhere
+                    key = str(target.path)
+                    future, leader = _join_flight(key)
+                    if not leader:
+                        return await asyncio.wrap_future(future)
+                    try:
+                        # Written by the last flight right before
+                        output = __read(target)
+                        if output is _MISSING:
+                            output = __finish(target, await func(*args, **kwargs), args, kwargs)
+                    except BaseException as e:
+                        future.set_exception(e)
+                        raise
+                    else:
+                        future.set_result(output)
+                        return output
+                    finally:
+                        _land_flight(key, future)
+
+                return __async_wrapper
+
+            @wraps(func)
+            def __wrapper(*args, **kwargs) -> Any:
+                target = __prepare(args, kwargs)
+                output = __read(target)
+                if output is not _MISSING:
+                    return output
+                # Single flight: wait for the same call running elsewhere
+                key = str(target.path)
+                future, leader = _join_flight(key)
+                if not leader:
+                    return future.result()
+                try:
+                    # Written by the last flight right before
+                    output = __read(target)
+                    if output is _MISSING:
+                        output = __finish(target, func(*args, **kwargs), args, kwargs)
+                except BaseException as e:
+                    future.set_exception(e)
+                    raise
+                else:
+                    future.set_result(output)
+                    return output
+                finally:
+                    _land_flight(key, future)
+
             return __wrapper
 
         return __func
 
 
+class MemoryCache(object):
+    """
+    In-memory LRU Cache
+    Bounded by total length of values (bytes)
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._items
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.stats['misses'] += 1
+                return None
+            self._items.move_to_end(key)
+            self.stats['hits'] += 1
+            return value
+
+    def put(self, key: str, value: Any) -> None:
+        if len(value) > self.limit:
+            return
+        with self._lock:
+            self._pop(key)
+            self._items[key] = value
+            self.size += len(value)
+            while self.size > self.limit:
+                self.size -= len(self._items.popitem(last=False)[1])
+                self.stats['evictions'] += 1
+
+    def _pop(self, key: str) -> Any:
+        value = self._items.pop(key, None)
+        if value is not None:
+            self.size -= len(value)
+        return value
+
+    def pop(self, key: str) -> Any:
+        with self._lock:
+            return self._pop(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+
 class Cache(DataFile):
+    # Memory tier shared by the subclass, set to enable
+    memory: ClassVar[Optional[MemoryCache]] = None
     enable: Optional[bool] = CACHE_ENABLE
     no_init: Optional[bool] = False
     header: Optional[bytes] = None
@@ -168,7 +312,36 @@ class Cache(DataFile):
 
     @property
     def path(self) -> Path:
-        return Path('cache', super().path)
+        # Format: cache/category/<first 2 chars>/filename.suffix
+        path = super().path
+        return Path('cache', path.parent, shard(self.filename), path.name)
+
+    def read(self) -> Any:
+        if self.memory is None:
+            output = super().read()
+        else:
+            key = str(self.path)
+            output = self.memory.get(key)
+            if output is None:
+                # Promote to memory on disk hits
+                output = super().read()
+                self.memory.put(key, output)
+        cache_manager.hit(self.path)
+        return output
+
+    def write(self, data: Any) -> int:
+        output = super().write(data)
+        if self.memory is not None:
+            self.memory.put(str(self.path), data)
+        # Characters for text, close enough for the quota and corrected by compaction
+        cache_manager.add(self.path, output)
+        return output
+
+    def delete(self):
+        if self.memory is not None:
+            self.memory.pop(str(self.path))
+        super().delete()
+        cache_manager.remove(self.path)
 
     @staticmethod
     def _exe_pre_encode(arg: Any) -> bytes:
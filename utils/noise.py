@@ -1,16 +1,35 @@
 # From salaxieb/perlin_noise
 
+import mmap
+import os
 import pickle
-from typing import Tuple, Union, List, Optional
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+from typing import Dict, Iterator, Tuple, Union, List, Optional
+from zipfile import BadZipFile
 
 import numpy as np
+from numpy.lib.format import open_memmap
 from numpy.random import Generator, SeedSequence, PCG64DXSM
 
+from .const import FILE, NOISE
+from .file import Cache, DataCheckError, cache_manager
 from .hash import hash_encode
 from .logger import logger
 from .model import QiModel
 
+CACHE_ENABLE = FILE.CACHE_ENABLE
+
 TYPE_SIZE = Union[Tuple[int, ...], List[int], np.ndarray]
+# Output target: array (np.memmap) or path of .npy file
+TYPE_OUT = Union[np.ndarray, str, Path, None]
+TYPE_DTYPE = Union[type, str, np.dtype]
+
+# Max amount of cached per-octave layers of each PerlinNoise
+LAYERS_CACHE_SIZE = 4
 
 
 def _random(entropy, spawn_key):
@@ -22,16 +41,56 @@ def _random(entropy, spawn_key):
 _np_random = np.vectorize(_random, excluded=['entropy', 0], signature='(n)->(n)')
 
 
-def _rand_vec(seed, grids):
+def _legacy_rand_vec(seed, grids):
     # Grid vectors: shape = (dim, <size*dim>)
     # Random vectors: n-dim rand array
-    return _np_random(seed, np.mgrid[map(slice, grids)].T).T
+    return _np_random(seed, np.mgrid[tuple(map(slice, grids))].T).T
+
+
+_MASK = 2 ** 64 - 1
+_GOLDEN = 0x9E3779B97F4A7C15
+
+
+def _mix(x: np.ndarray) -> np.ndarray:
+    # SplitMix64 finalizer, wraps on uint64
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def _hash_vec(seed, coords: np.ndarray) -> np.ndarray:
+    # Lattice coordinates: int array, shape = (dim, <any>)
+    # Random unit vectors: shape = (dim, <any>), only depend on (seed, coordinates)
+    dim = len(coords)
+    key = SeedSequence(seed).generate_state(1, np.uint64)[0]
+    with np.errstate(over='ignore'):
+        h = np.full(coords.shape[1:], key, dtype=np.uint64)
+        for axis in coords.astype(np.int64).astype(np.uint64):
+            h = _mix((h ^ axis) + np.uint64(_GOLDEN))
+        # Two uniform numbers for each component, Box-Muller to normal
+        bits = _mix(h + np.array(
+            [(i + 1) * _GOLDEN & _MASK for i in range(2 * dim)], dtype=np.uint64
+        ).reshape([-1] + [1] * h.ndim)) >> np.uint64(11)
+    u = bits * 2.0 ** -53
+    vec = np.sqrt(-2 * np.log1p(-u[:dim])) * np.cos(2 * np.pi * u[dim:])
+    return vec / np.linalg.norm(vec, axis=0)
+
+
+def _rand_vec(seed, grids, legacy: bool = False):
+    if legacy:
+        return _legacy_rand_vec(seed, grids)
+    return _hash_vec(seed, np.mgrid[tuple(map(slice, grids))])
 
 
 def _fade(x):
     return x ** 3 * (6 * x ** 2 - 15 * x + 10)
 
 
+def _d_fade(x):
+    # Derivative of _fade()
+    return 30 * x ** 2 * (x - 1) ** 2
+
+
 class PerlinNoiseState(QiModel):
     grids: np.ndarray
     grid_size: np.ndarray
@@ -47,6 +106,121 @@ class PerlinNoiseCache(QiModel):
     weight: np.ndarray
 
 
+class PerlinNoiseStateCache(Cache):
+    """
+    PerlinNoiseState Cache
+    Format: cache/noise/<md5 prefix>/<md5 of params>.npz
+    Least recently used files are removed when exceeding the size limit
+    """
+    category: str = 'noise'
+    suffix: str = 'npz'
+    is_elf: bool = True
+    limit: Optional[int] = NOISE.CACHE_LIMIT
+
+    def __init__(self, filename: str, enable: bool = None, limit: int = None):
+        super().__init__(filename, enable=enable)
+        if limit is not None:
+            self.limit = limit
+
+    def read(self) -> PerlinNoiseState:
+        if not self.exists:
+            raise DataCheckError(f'{self.path} not found!')
+        try:
+            with np.load(self.path) as data:
+                state = PerlinNoiseState(**data)
+        except (OSError, ValueError, KeyError, BadZipFile) as e:
+            raise DataCheckError(f'Broken cache {self.path}: {e}')
+        # Mark as recently used
+        os.utime(self.path)
+        cache_manager.hit(self.path)
+        return state
+
+    def write(self, data: PerlinNoiseState) -> int:
+        if not self.path.parent.is_dir():
+            self.path.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+        # Write to a temp file first, never leave a broken cache
+        temp_path = self.path.with_suffix(f'.{os.getpid()}.tmp')
+        with temp_path.open('wb') as f:
+            np.savez_compressed(f, **data.__dict__)
+        temp_path.replace(self.path)
+        size = self.path.stat().st_size
+        cache_manager.add(self.path, size)
+        self.evict()
+        return size
+
+    def evict(self):
+        files = []
+        for file in self.path.parent.parent.glob(f'*/*.{self.suffix}'):
+            try:
+                files.append((file.stat(), file))
+            except FileNotFoundError:
+                pass
+        total = 0
+        for stat, file in sorted(files, key=lambda x: x[0].st_mtime, reverse=True):
+            total += stat.st_size
+            if total > self.limit:
+                file.unlink(True)
+                cache_manager.remove(file)
+
+
+# (shared memory name, shape, dtype)
+TYPE_SHARED = Tuple[str, Tuple[int, ...], str]
+# (file name, offset, shape, dtype)
+TYPE_MAPPED = Tuple[str, int, Tuple[int, ...], str]
+
+# Worker globals of generate_parallel()
+_worker_noise: Optional['PerlinNoise'] = None
+_worker_out: Optional[np.ndarray] = None
+_worker_memories: List[SharedMemory] = []
+
+
+def _share_empty(shape: Tuple[int, ...], dtype: TYPE_DTYPE, memories: List[SharedMemory]) -> TYPE_SHARED:
+    dtype = np.dtype(dtype)
+    memory = SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+    memories.append(memory)
+    return memory.name, tuple(shape), dtype.str
+
+
+def _share(array: np.ndarray, memories: List[SharedMemory]) -> TYPE_SHARED:
+    info = _share_empty(array.shape, array.dtype, memories)
+    np.ndarray(array.shape, array.dtype, memories[-1].buf)[...] = array
+    return info
+
+
+def _mapped(array: np.ndarray) -> Optional[TYPE_MAPPED]:
+    # A whole memmap can be opened again by workers, views and other arrays can not
+    if isinstance(array, np.memmap) and isinstance(array.base, mmap.mmap) and array.filename and \
+            array.flags.c_contiguous and array.flags.writeable:
+        return array.filename, array.offset, array.shape, array.dtype.str
+    return None
+
+
+def _attach(info: Union[TYPE_SHARED, TYPE_MAPPED]) -> np.ndarray:
+    if len(info) == 4:
+        filename, offset, shape, dtype = info
+        return np.memmap(filename, dtype, mode='r+', offset=offset, shape=shape)
+    name, shape, dtype = info
+    memory = SharedMemory(name=name)
+    _worker_memories.append(memory)
+    return np.ndarray(shape, dtype, memory.buf)
+
+
+def _init_worker(size, seed, legacy: bool, state: Dict[str, TYPE_SHARED], out: Union[TYPE_SHARED, TYPE_MAPPED]):
+    # Attach state & output once per process
+    global _worker_noise, _worker_out
+    _worker_noise = PerlinNoise(
+        size=size,
+        seed=seed,
+        legacy=legacy,
+        init_state=PerlinNoiseState(**{k: _attach(v) for k, v in state.items()})
+    )
+    _worker_out = _attach(out)
+
+
+def _run_slab(in_index: Tuple[slice, ...], out_index: Tuple[slice, ...]):
+    _worker_out[out_index] = _worker_noise.generate(np.mgrid[in_index])
+
+
 class PerlinNoise(object):
 
     def __init__(self,
@@ -55,9 +229,21 @@ class PerlinNoise(object):
                  detail: int = 2,
                  blend: float = 0.5,
                  seed=None,
+                 legacy: bool = False,
+                 keep_cache: bool = False,
+                 dtype: TYPE_DTYPE = np.float64,
+                 cache_state: bool = False,
+                 infinite: bool = False,
                  init_state: PerlinNoiseState = None):
-        # Cache
-        self.cache: Optional[PerlinNoiseState] = None
+        # Cache (intermediates of the last generate(), for debugging only)
+        self.keep_cache = keep_cache
+        self.cache: Optional[PerlinNoiseCache] = None
+        # Scratch buffers of generate(scratch=True)
+        self._scratch: Dict[str, np.ndarray] = {}
+        # Per-octave layers of generate_layers(), LRU keyed by geometry
+        self._layers: OrderedDict = OrderedDict()
+        # Use per-point RNG vectors of old versions
+        self._legacy = legacy
         # Fast init from another class
         if init_state:
             self._size = size
@@ -69,15 +255,44 @@ class PerlinNoise(object):
         scale = self._parse_scale(scale)
         detail = self._parse_detail(detail)
         blend = self._parse_blend(blend)
+        # A random seed never hits the cache again
+        cache_state = cache_state and seed is not None
         seed = self._parse_seed(seed)
+        dtype = self._parse_dtype(dtype)
+        if infinite and legacy:
+            raise ValueError('Legacy vectors are not supported in infinite mode.')
+
+        # Load state from disk cache or generate it
+        state_cache = PerlinNoiseStateCache(
+            PerlinNoiseStateCache.encode(repr((
+                tuple(size.tolist()), float(scale), detail, float(blend), seed, legacy, dtype.str, infinite
+            ))),
+            enable=cache_state and CACHE_ENABLE
+        )
+        self.state = state_cache(self._build_state)(size, scale, detail, blend, seed, legacy, dtype, infinite)
+        self._size = size
+        self._seed = seed
 
+    @staticmethod
+    def _build_state(size: np.ndarray,
+                     scale: float,
+                     detail: int,
+                     blend: float,
+                     seed: int,
+                     legacy: bool,
+                     dtype: np.dtype,
+                     infinite: bool = False) -> PerlinNoiseState:
         # Generate grids of random vectors
         max_grid_size = max(size) / scale / 2 ** (detail - 1)
         # Amount of grids
         grids = np.ceil(size / max_grid_size).astype(int) + 1
         # grids = tuple(math.ceil(_ / max_grid_size) + 1 for _ in size)
         # Random vectors, n-dim rand array
-        rand_vec = _rand_vec(seed, grids)
+        # Infinite mode: empty, vectors are hashed from lattice coordinates on demand
+        if infinite:
+            rand_vec = np.empty((len(size), 0), dtype)
+        else:
+            rand_vec = _rand_vec(seed, grids, legacy).astype(dtype)
 
         # Dimension (n)
         dim = len(size)
@@ -85,26 +300,22 @@ class PerlinNoise(object):
         _l_dim = [1] * dim
         # Grid size (for FBM)
         # shape = (1, 1, detail, <1*dim>)
-        grid_size = max_grid_size * 2 ** np.arange(detail)[::-1].reshape([1, 1, -1] + _l_dim)
+        grid_size = (max_grid_size * 2 ** np.arange(detail)[::-1].reshape([1, 1, -1] + _l_dim)).astype(dtype)
 
         # Combination of 0 & 1
         # shape = (dim, 2^dim, 1, <1*dim>)
-        delta_box = np.mgrid[[slice(2)] * dim].reshape([dim, -1, 1] + _l_dim)
+        delta_box = np.mgrid[[slice(2)] * dim].reshape([dim, -1, 1] + _l_dim).astype(dtype)
 
         # Blend
-        blend_weight = 0.5 ** np.arange(detail).reshape([-1] + _l_dim) * blend
-        blend_weight[0] = 1
+        blend_weight = PerlinNoise._blend_weight(detail, blend, dim).astype(dtype)
 
-        # Write to state
-        self.state = PerlinNoiseState(
+        return PerlinNoiseState(
             grids=grids,
             grid_size=grid_size,
             rand_vec=rand_vec,
             delta_box=delta_box,
             blend_weight=blend_weight
         )
-        self._size = size
-        self._seed = seed
 
     @staticmethod
     def _parse_size(size: TYPE_SIZE) -> np.ndarray:
@@ -117,6 +328,22 @@ class PerlinNoise(object):
     def size(self) -> Tuple[int, ...]:
         return tuple(self._size)
 
+    @staticmethod
+    def _parse_dtype(dtype: TYPE_DTYPE) -> np.dtype:
+        dtype = np.dtype(dtype)
+        if dtype not in (np.float32, np.float64):
+            raise ValueError(f'Incorrect dtype: {dtype}.')
+        return dtype
+
+    @property
+    def dtype(self) -> np.dtype:
+        # float32 halves memory, abs error to the float64 result stays below 1e-6
+        return self.state.grid_size.dtype
+
+    @staticmethod
+    def _index_dtype(dtype: np.dtype) -> type:
+        return np.int32 if dtype == np.float32 else int
+
     @staticmethod
     def _parse_scale(scale: float) -> float:
         if not 0.01 <= scale <= 100:
@@ -151,6 +378,13 @@ class PerlinNoise(object):
     def blend(self) -> float:
         return self.state.blend_weight[1] * 2
 
+    @staticmethod
+    def _blend_weight(detail: int, blend: float, dim: int) -> np.ndarray:
+        # shape = (detail, <1*dim>)
+        blend_weight = 0.5 ** np.arange(detail).reshape([-1] + [1] * dim) * blend
+        blend_weight[0] = 1
+        return blend_weight
+
     @staticmethod
     def _parse_seed(seed=None, force_encode: bool = True) -> int:
         if seed is None:
@@ -168,66 +402,606 @@ class PerlinNoise(object):
 
     def reseed(self, seed) -> 'PerlinNoise':
         seed = self._parse_seed(seed)
+        if self.infinite:
+            return self.__class__(size=self._size, seed=seed, keep_cache=self.keep_cache, init_state=self.state)
         return self.__class__(
             size=self._size,
             seed=seed,
+            legacy=self._legacy,
+            keep_cache=self.keep_cache,
             init_state=self.state.copy(
                 update={
-                    'rand_vec': _rand_vec(seed, self.state.grids)
+                    'rand_vec': _rand_vec(seed, self.state.grids, self._legacy).astype(self.dtype)
                 }
             )
         )
 
+    @property
+    def legacy(self) -> bool:
+        return self._legacy
+
+    @property
+    def infinite(self) -> bool:
+        # Unbounded coordinates, no rand_vec stored
+        return self.state.rand_vec.size == 0
+
+    def _gather(self, rand_vec: np.ndarray, box: np.ndarray, seed=None) -> np.ndarray:
+        # Rand vectors of lattice points, shape of box = (dim, <any>)
+        if self.infinite:
+            return _hash_vec(self._seed if seed is None else seed, box).astype(rand_vec.dtype)
+        return rand_vec[tuple([...] + list(box))]
+
     @property
     def dim(self) -> int:
         return len(self.state.grids)
 
-    def generate_all(self, step: Union[List[int], int] = 1) -> np.ndarray:
-        if type(step) is int:
-            step = [step]
-        index = map(
+    def _per_dim(self, value: Union[TYPE_SIZE, int]) -> np.ndarray:
+        # Repeat int/list values for each dim
+        if type(value) is int:
+            value = [value]
+        return np.array(value)[np.arange(self.dim) % len(value)]
+
+    def _grid_index(self, step: Union[List[int], int] = 1) -> Tuple[slice, ...]:
+        return tuple(map(
             lambda x, y: slice(0, x, y),
             self._size,
-            np.array(step)[np.arange(self.dim) % len(step)]
+            self._per_dim(step)
+        ))
+
+    def generate_tiles(self,
+                       tile_shape: Union[TYPE_SIZE, int],
+                       step: Union[List[int], int] = 1
+                       ) -> Iterator[Tuple[Tuple[slice, ...], np.ndarray]]:
+        # Walk the output in blocks, yield (output index, block)
+        # Peak memory depends on tile_shape only
+        index = self._grid_index(step)
+        shape = np.array([len(range(_.start, _.stop, _.step)) for _ in index])
+        tile_shape = self._parse_size(self._per_dim(tile_shape).tolist())
+        for tile in np.ndindex(*np.ceil(shape / tile_shape).astype(int)):
+            out_index = tuple(map(
+                lambda i, t, s: slice(i * t, min((i + 1) * t, s)),
+                tile, tile_shape, shape
+            ))
+            in_index = tuple(map(
+                lambda x, y: slice(x.start + y.start * x.step, x.start + y.stop * x.step, x.step),
+                index, out_index
+            ))
+            yield out_index, self.generate(np.mgrid[in_index])
+
+    @staticmethod
+    def _parse_out(out: TYPE_OUT, shape: TYPE_SIZE, dtype: TYPE_DTYPE = float) -> Optional[np.ndarray]:
+        if out is None:
+            return None
+        if isinstance(out, (str, Path)):
+            # Write to disk directly
+            path = Path(out)
+            if not path.parent.is_dir():
+                path.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+            return open_memmap(path, mode='w+', dtype=dtype, shape=tuple(shape))
+        if tuple(out.shape) != tuple(shape):
+            raise ValueError(f'Incorrect output shape: {out.shape}, expect {tuple(shape)}.')
+        return out
+
+    def generate_all(self,
+                     step: Union[List[int], int] = 1,
+                     chunk: Union[TYPE_SIZE, int] = None,
+                     out: TYPE_OUT = None) -> np.ndarray:
+        index = self._grid_index(step)
+        if chunk is None:
+            return self.generate(np.mgrid[index], out=out)
+        shape = [len(range(_.start, _.stop, _.step)) for _ in index]
+        out = self._parse_out(out, shape, self.dtype)
+        if out is None:
+            out = np.empty(shape, self.dtype)
+        for out_index, block in self.generate_tiles(chunk, step):
+            out[out_index] = block
+        if isinstance(out, np.memmap):
+            out.flush()
+        return out
+
+    def generate_parallel(self,
+                          step: Union[List[int], int] = 1,
+                          workers: int = None,
+                          slabs: int = None,
+                          out: TYPE_OUT = None) -> np.ndarray:
+        # Split the output into slabs along the first axis
+        # State and output are shared with workers, not pickled per task
+        # Workers write into a memmap output directly, other outputs are copied once
+        index = self._grid_index(step)
+        shape = [len(range(_.start, _.stop, _.step)) for _ in index]
+        workers = workers if workers else os.cpu_count() or 1
+        slabs = min(slabs if slabs else workers * 4, shape[0])
+        bounds = np.linspace(0, shape[0], slabs + 1).astype(int)
+        target = self._parse_out(out, shape, self.dtype)
+        memories: List[SharedMemory] = []
+        try:
+            state = {k: _share(v, memories) for k, v in self.state.__dict__.items()}
+            out_info = _mapped(target) if target is not None else None
+            if out_info is None:
+                out_info = _share_empty(tuple(shape), self.dtype if target is None else target.dtype, memories)
+            with ProcessPoolExecutor(
+                    max_workers=workers,
+                    initializer=_init_worker,
+                    initargs=(self._size, self._seed, self._legacy, state, out_info)
+            ) as executor:
+                futures = []
+                for start, stop in zip(bounds[:-1], bounds[1:]):
+                    out_index = (slice(start, stop),)
+                    x = index[0]
+                    in_index = (slice(x.start + start * x.step, x.start + stop * x.step, x.step),) + index[1:]
+                    futures.append(executor.submit(_run_slab, in_index, out_index))
+                for future in futures:
+                    future.result()
+            if len(out_info) == 3:
+                buffer = np.ndarray(out_info[1], out_info[2], memories[-1].buf)
+                if target is None:
+                    target = buffer.copy()
+                else:
+                    target[...] = buffer
+                # Release the view before closing shared memory
+                del buffer
+        finally:
+            for memory in memories:
+                memory.close()
+                memory.unlink()
+        if isinstance(target, np.memmap):
+            target.flush()
+        return target
+
+    def _state_as(self, dtype: np.dtype) -> PerlinNoiseState:
+        if dtype == self.dtype:
+            return self.state
+        return PerlinNoiseState.construct(
+            grids=self.state.grids,
+            **{k: getattr(self.state, k).astype(dtype)
+               for k in ('grid_size', 'rand_vec', 'delta_box', 'blend_weight')}
         )
-        return self.generate(np.mgrid[index])
 
-    def generate(self,
-                 input_element: np.ndarray = None,
-                 order: str = 'F',
-                 repeat: bool = False) -> np.ndarray:
+    def _get_scratch(self, input_shape: Tuple[int, ...], dtype: np.dtype) -> Dict[str, np.ndarray]:
+        # Reuse buffers if the input shape is unchanged
+        if self._scratch.get('key', None) == (input_shape, dtype):
+            return self._scratch
+        dim, size = self.dim, input_shape[1:]
+        detail = self.state.grid_size.shape[2]
+        # shape = (dim, 2^dim, detail, <size*dim>)
+        full = (dim, 2 ** dim, detail) + size
+        self._scratch = {
+            'key': (input_shape, dtype),
+            'coordinates': np.empty((dim, 1, detail) + size, dtype),
+            'box': np.empty(full, dtype),
+            'box_int': np.empty(full, self._index_dtype(dtype)),
+            'distance': np.empty(full, dtype),
+            'fade': np.empty(full, dtype),
+            'temp': np.empty(full, dtype),
+            'coord_rand': np.empty(full, dtype),
+            'index': np.empty(full[1:], int),
+            'weight': np.empty(full[1:], dtype),
+            'dot': np.empty(full[1:], dtype),
+            'octave': np.empty(full[2:], dtype)
+        }
+        return self._scratch
+
+    def clear_scratch(self):
+        self._scratch = {}
+
+    def _generate_scratch(self,
+                          input_element: np.ndarray,
+                          state: PerlinNoiseState,
+                          repeat: bool = False) -> np.ndarray:
+        # Same steps as generate(), but written into preallocated buffers
+        buf = self._get_scratch(input_element.shape, input_element.dtype)
+        coordinates, box, box_int = buf['coordinates'], buf['box'], buf['box_int']
+        distance, fade, temp = buf['distance'], buf['fade'], buf['temp']
+        np.divide(input_element[:, None, None], state.grid_size, out=coordinates)
+        np.floor_divide(coordinates, 1, out=box)
+        np.add(box, state.delta_box, out=box)
+        np.subtract(coordinates, box, out=distance)
+
+        # Index rand vectors (flat index, bounds checked like fancy indexing)
+        np.copyto(box_int, box, casting='unsafe')
+        grids = state.grids.reshape([-1, 1, 1] + [1] * self.dim)
+        coord_rand = buf['coord_rand']
+        if self.infinite:
+            coord_rand[...] = self._gather(state.rand_vec, box_int)
+        elif not repeat:
+            for axis, grid in zip(box_int, state.grids):
+                if axis.min() < -grid or axis.max() >= grid:
+                    raise IndexError(f'Index out of bounds for grids {tuple(state.grids)}.')
+        if not self.infinite:
+            np.remainder(box_int, grids, out=box_int)
+            index = buf['index']
+            index[...] = box_int[0]
+            for axis, grid in zip(box_int[1:], state.grids[1:]):
+                np.multiply(index, grid, out=index)
+                np.add(index, axis, out=index)
+            for vec, rand in zip(coord_rand, state.rand_vec.reshape(self.dim, -1)):
+                np.take(rand, index, out=vec, mode='wrap')
+
+        # Calculate weights, fade(x) = x^3 * (6x^2 - 15x + 10)
+        np.abs(distance, out=fade)
+        np.subtract(1, fade, out=fade)
+        np.square(fade, out=temp)
+        np.multiply(temp, 6, out=temp)
+        np.subtract(temp, np.multiply(fade, 15, out=box), out=temp)
+        np.add(temp, 10, out=temp)
+        np.power(fade, 3, out=fade)
+        np.multiply(fade, temp, out=fade)
+        weight, dot = buf['weight'], buf['dot']
+        np.prod(fade, axis=0, out=weight)
+        np.multiply(coord_rand, distance, out=temp)
+        np.sum(temp, axis=0, out=dot)
+        np.multiply(weight, dot, out=weight)
+
+        # Calculate sum
+        octave = buf['octave']
+        np.sum(weight, axis=0, out=octave)
+        np.multiply(octave, state.blend_weight, out=octave)
+        return np.sum(octave, axis=0)
+
+    def _parse_input(self,
+                     input_element: Optional[np.ndarray],
+                     order: str,
+                     dtype: TYPE_DTYPE = None) -> Tuple[np.ndarray, str, np.dtype]:
+        # Default grid or transposed input, cast to the compute dtype
         if input_element is None:
-            input_element = np.mgrid[map(slice, self._size)]
+            input_element = np.mgrid[tuple(map(slice, self._size))]
             order = 'F'
         elif order == 'C':
             input_element = input_element.T
+        # All temporaries follow the compute dtype
+        dtype = self._parse_dtype(dtype) if dtype else self.dtype
+        return input_element.astype(dtype, copy=False), order, dtype
+
+    def _prepare(self,
+                 input_element: np.ndarray,
+                 state: PerlinNoiseState,
+                 repeat: bool = False) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
         # Input coordinates (add dim to repeat)
         # shape = (dim, 1, detail, <size*dim>)
-        coordinates = input_element[:, None, None] / self.state.grid_size
+        coordinates = input_element[:, None, None] / state.grid_size
         # Generate bounding box (repeat for final sum)
         # shape = (dim, 2^dim, detail, <size*dim>)
-        coord_bounding_box = (coordinates // 1).astype(int) + self.state.delta_box
+        coord_bounding_box = coordinates // 1 + state.delta_box
         # Distance vectors
         distance = coordinates - coord_bounding_box
-
+        coord_bounding_box = coord_bounding_box.astype(self._index_dtype(input_element.dtype))
+        if repeat and not self.infinite:
+            coord_bounding_box %= state.grids.reshape([-1, 1, 1] + [1] * self.dim).astype(coord_bounding_box.dtype)
+        return coordinates, coord_bounding_box, distance
+
+    def _weight(self,
+                state: PerlinNoiseState,
+                coord_bounding_box: np.ndarray,
+                distance: np.ndarray) -> Tuple[np.ndarray, ...]:
         # Index rand vectors
-        if repeat:
-            coord_bounding_box %= self.state.grids.reshape([-1, 1, 1] + [1] * self.dim)
-        coord_rand = self.state.rand_vec[tuple([...] + list(coord_bounding_box))]
+        coord_rand = self._gather(state.rand_vec, coord_bounding_box)
         # Calculate weights
         # shape = (2^dim, detail, <size*dim>)
-        weight = np.prod(_fade(1 - np.abs(distance)), axis=0) * np.sum(coord_rand * distance, axis=0)
+        fade = _fade(1 - np.abs(distance))
+        fade_prod = np.prod(fade, axis=0)
+        dot = np.sum(coord_rand * distance, axis=0)
+        return coord_rand, fade, fade_prod, dot, fade_prod * dot
 
-        # Calculate sum
-        out = np.sum(np.sum(weight, axis=0) * self.state.blend_weight, axis=0)
-        # Write cache
-        self.cache = PerlinNoiseCache(
-            coordinates=coordinates,
-            distance=distance,
-            coord_rand=coord_rand,
-            weight=weight
-        )
+    def generate(self,
+                 input_element: np.ndarray = None,
+                 order: str = 'F',
+                 repeat: bool = False,
+                 out: TYPE_OUT = None,
+                 scratch: bool = False,
+                 dtype: TYPE_DTYPE = None,
+                 gradient: bool = False) -> Union[np.ndarray, Tuple[np.ndarray, np.ndarray]]:
+        # With gradient=True, return (noise, d(noise)/d(input))
+        # shape of gradient = (dim, <size*dim>), transposed as well for order='C'
+        input_element, order, dtype = self._parse_input(input_element, order, dtype)
+        state = self._state_as(dtype)
+        grad = None
+        if gradient:
+            # Gradient needs the full intermediates, no scratch path
+            result, grad = self._generate(input_element, state, repeat, True)
+        elif scratch:
+            # Fast path: reuse buffers, no cache written
+            result = self._generate_scratch(input_element, state, repeat)
+        else:
+            result = self._generate(input_element, state, repeat)
         # Output
         if order == 'C':
-            return out.T
+            result = result.T
+            grad = None if grad is None else grad.T
+        out = self._parse_out(out, result.shape, dtype)
+        if out is not None:
+            out[...] = result
+            if isinstance(out, np.memmap):
+                out.flush()
+            result = out
+        if gradient:
+            return result, grad
+        return result
+
+    def _generate(self,
+                  input_element: np.ndarray,
+                  state: PerlinNoiseState,
+                  repeat: bool = False,
+                  gradient: bool = False) -> Union[np.ndarray, Tuple[np.ndarray, np.ndarray]]:
+        coordinates, coord_bounding_box, distance = self._prepare(input_element, state, repeat)
+        coord_rand, fade, fade_prod, dot, weight = self._weight(state, coord_bounding_box, distance)
+
+        # Calculate sum
+        result = np.sum(np.sum(weight, axis=0) * state.blend_weight, axis=0)
+        grad = None
+        if gradient:
+            # d(weight)/d(distance_j) = d(fade_j) * prod(fade of others) * dot + prod(fade) * rand_j
+            # d(distance)/d(input) = 1 / grid_size
+            d_fade = _d_fade(1 - np.abs(distance)) * -np.sign(distance)
+            grad = np.empty((self.dim,) + result.shape, result.dtype)
+            for axis in range(self.dim):
+                partial = np.prod(np.concatenate(
+                    [fade[:axis], d_fade[axis:axis + 1], fade[axis + 1:]]
+                ), axis=0) * dot + fade_prod * coord_rand[axis]
+                grad[axis] = np.sum(np.sum(partial, axis=0) / state.grid_size[0, 0] * state.blend_weight, axis=0)
+        # Write cache (opt-in, skip validation)
+        if self.keep_cache:
+            self.cache = PerlinNoiseCache.construct(
+                coordinates=coordinates,
+                distance=distance,
+                coord_rand=coord_rand,
+                weight=weight
+            )
+        if gradient:
+            return result, grad
+        return result
+
+    def generate_layers(self,
+                        input_element: np.ndarray = None,
+                        order: str = 'F',
+                        repeat: bool = False,
+                        cache: bool = True,
+                        dtype: TYPE_DTYPE = None) -> np.ndarray:
+        # Octaves before blending, shape = (detail, <size*dim>)
+        input_element, order, dtype = self._parse_input(input_element, order, dtype)
+        key = (hash_encode(np.ascontiguousarray(input_element).tobytes()),
+               input_element.shape, order, repeat, dtype.str)
+        if cache and key in self._layers:
+            self._layers.move_to_end(key)
+            return self._layers[key]
+        state = self._state_as(dtype)
+        _, coord_bounding_box, distance = self._prepare(input_element, state, repeat)
+        layers = np.sum(self._weight(state, coord_bounding_box, distance)[-1], axis=0)
+        if order == 'C':
+            layers = layers.transpose([0] + list(range(layers.ndim - 1, 0, -1)))
+        if cache:
+            self._layers[key] = layers
+            while len(self._layers) > LAYERS_CACHE_SIZE:
+                self._layers.popitem(last=False)
+        return layers
+
+    def blend_layers(self,
+                     layers: np.ndarray,
+                     blend: float = None,
+                     weights: List[float] = None) -> np.ndarray:
+        # Blend octaves with a new blend value or custom weights of each octave
+        if weights is not None:
+            blend_weight = np.array(weights, layers.dtype).reshape([-1] + [1] * (layers.ndim - 1))
+            if len(blend_weight) != len(layers):
+                raise ValueError(f'Incorrect weights: expect {len(layers)} values.')
+        elif blend is not None:
+            blend_weight = self._blend_weight(len(layers), self._parse_blend(blend), layers.ndim - 1)
+            blend_weight = blend_weight.astype(layers.dtype)
+        else:
+            blend_weight = self.state.blend_weight.reshape([-1] + [1] * (layers.ndim - 1)).astype(layers.dtype)
+        return np.sum(layers * blend_weight, axis=0)
+
+    def reblend(self,
+                blend: float = None,
+                weights: List[float] = None,
+                input_element: np.ndarray = None,
+                order: str = 'F',
+                repeat: bool = False,
+                dtype: TYPE_DTYPE = None) -> np.ndarray:
+        # Cached layers are reused, only the weighted sum is computed again
+        return self.blend_layers(self.generate_layers(input_element, order, repeat, dtype=dtype), blend, weights)
+
+    def clear_layers(self):
+        self._layers = OrderedDict()
+
+    def generate_seeds(self,
+                       seeds: List,
+                       input_element: np.ndarray = None,
+                       order: str = 'F',
+                       repeat: bool = False,
+                       dtype: TYPE_DTYPE = None) -> np.ndarray:
+        # Noise of several seeds in one pass, shape = (seeds, <size*dim>)
+        # Geometry (coordinates, distance, fade) is shared, only rand vectors differ
+        input_element, order, dtype = self._parse_input(input_element, order, dtype)
+        state = self._state_as(dtype)
+        seeds = [self._parse_seed(seed) for seed in seeds]
+        _, coord_bounding_box, distance = self._prepare(input_element, state, repeat)
+        # shape = (2^dim, detail, <size*dim>)
+        fade = np.prod(_fade(1 - np.abs(distance)), axis=0)
+        # shape = (seeds, dim, 2^dim, detail, <size*dim>)
+        if self.infinite:
+            coord_rand = np.stack([self._gather(state.rand_vec, coord_bounding_box, seed) for seed in seeds])
+        else:
+            # shape = (seeds, dim, <grids*dim>)
+            rand_vec = np.stack([
+                _rand_vec(seed, state.grids, self._legacy).astype(dtype) for seed in seeds
+            ])
+            coord_rand = rand_vec[tuple([slice(None), slice(None)] + list(coord_bounding_box))]
+        # shape = (seeds, 2^dim, detail, <size*dim>)
+        weight = fade * np.sum(coord_rand * distance, axis=1)
+        result = np.sum(np.sum(weight, axis=1) * state.blend_weight, axis=1)
+        if order == 'C':
+            return result.transpose([0] + list(range(result.ndim - 1, 0, -1)))
+        return result
+
+    def query(self,
+              points: np.ndarray,
+              batch: int = 65536,
+              repeat: bool = False,
+              sort: bool = False) -> np.ndarray:
+        # Noise of scattered points, shape of points = (n, dim), output = (n,)
+        # Points are processed in batches, each corner gathers rand vectors once per axis
+        # With sort=True, points are bucketed by lattice cell for each octave,
+        # may help when rand_vec is far larger than cache
+        state = self.state
+        points = np.asarray(points).astype(self.dtype, copy=False).reshape(-1, self.dim)
+        dim, detail = self.dim, len(state.blend_weight)
+        grid_size = state.grid_size.reshape(detail)
+        blend_weight = state.blend_weight.reshape(detail)
+        # Combination of 0 & 1, shape = (2^dim, dim)
+        corners = state.delta_box.reshape(dim, -1).T.astype(int)
+        rand_vec = state.rand_vec.reshape(dim, -1)
+        index_dtype = self._index_dtype(self.dtype)
+        grids = state.grids[:, None]
+        # Strides of the flat lattice index
+        strides = np.append(np.cumprod(state.grids[:0:-1])[::-1], 1)[:, None]
+        out = np.empty(len(points), self.dtype)
+        for start in range(0, len(points), batch):
+            batch_points = points[start:start + batch]
+            result = None
+            for octave in range(detail):
+                # shape = (dim, batch)
+                coordinates = batch_points.T / grid_size[octave]
+                cell = coordinates // 1
+                cell_index = cell.astype(index_dtype)
+                if not repeat and not self.infinite:
+                    for axis, grid in zip(cell_index, state.grids):
+                        if axis.min() < -grid or axis.max() + 1 >= grid:
+                            raise IndexError(f'Index out of bounds for grids {tuple(state.grids)}.')
+                order = None
+                if sort:
+                    # Bucket points by lattice cell
+                    order = np.argsort(np.sum(cell_index % grids * strides, axis=0), kind='stable')
+                    coordinates, cell, cell_index = coordinates[:, order], cell[:, order], cell_index[:, order]
+                # Values of both sides (0 & 1) on each axis, shape = (2, dim, batch)
+                distance = coordinates - (cell + np.arange(2, dtype=self.dtype).reshape(-1, 1, 1))
+                fade = _fade(1 - np.abs(distance))
+                index = (cell_index + np.arange(2, dtype=index_dtype).reshape(-1, 1, 1)) % grids * strides
+                octave_sum = None
+                for corner in corners:
+                    flat = index[corner[0], 0]
+                    weight = fade[corner[0], 0]
+                    for axis in range(1, dim):
+                        flat = flat + index[corner[axis], axis]
+                        weight = weight * fade[corner[axis], axis]
+                    if self.infinite:
+                        vec = self._gather(state.rand_vec, cell_index + corner[:, None])
+                    else:
+                        vec = rand_vec[:, flat]
+                    dot = vec[0] * distance[corner[0], 0]
+                    for axis in range(1, dim):
+                        dot = dot + vec[axis] * distance[corner[axis], axis]
+                    weight = weight * dot
+                    octave_sum = weight if octave_sum is None else octave_sum + weight
+                octave_sum = octave_sum * blend_weight[octave]
+                if sort:
+                    # Scatter back to input order
+                    octave_out = np.empty_like(octave_sum)
+                    octave_out[order] = octave_sum
+                    octave_sum = octave_out
+                result = octave_sum if result is None else result + octave_sum
+            out[start:start + batch] = result
+        return out
+
+
+class PerlinNoiseWindow(object):
+    """
+    Incremental evaluator for scrolling/animated noise
+    Keep the last window in a ring buffer, only newly exposed cells are generated.
+    For time slices, use an (n+1)-dim noise and shift along the time axis.
+    Read `buffer` from `head` (wrapping around) to avoid copies,
+    `frame` and `get_frame()` copy the window in order.
+    """
+
+    def __init__(self,
+                 noise: PerlinNoise,
+                 shape: TYPE_SIZE,
+                 origin: TYPE_SIZE = None,
+                 step: Union[List[int], int] = 1,
+                 repeat: bool = False):
+        self.noise = noise
+        self.repeat = repeat
+        self._shape = noise._parse_size(shape)
+        if len(self._shape) != noise.dim:
+            raise ValueError(f'Incorrect window shape: {tuple(self._shape)}.')
+        self._step = noise._per_dim(step)
+        self._origin = np.zeros(noise.dim, int) if origin is None else np.array(origin, int)
+        # Ring position of the window origin
+        self._head = np.zeros(noise.dim, int)
+        self._buffer = np.empty(self._shape, noise.dtype)
+        self._update(np.zeros(noise.dim, int), self._shape)
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return tuple(self._shape)
+
+    @property
+    def origin(self) -> Tuple[int, ...]:
+        return tuple(self._origin)
+
+    @property
+    def buffer(self) -> np.ndarray:
+        # Read-only ring buffer, the window origin is at `head`
+        buffer = self._buffer.view()
+        buffer.flags.writeable = False
+        return buffer
+
+    @property
+    def head(self) -> Tuple[int, ...]:
+        return tuple(self._head)
+
+    @property
+    def frame(self) -> np.ndarray:
+        return self.get_frame()
+
+    def get_frame(self, out: np.ndarray = None) -> np.ndarray:
+        # Copy the window in order, block by block (at most 2^dim blocks)
+        if out is None:
+            out = np.empty(self._shape, self._buffer.dtype)
+        elif tuple(out.shape) != self.shape:
+            raise ValueError(f'Incorrect output shape: {out.shape}, expect {self.shape}.')
+        parts = [
+            [(slice(head, n), slice(0, n - head))] + ([(slice(0, head), slice(n - head, n))] if head else [])
+            for head, n in zip(self._head, self._shape)
+        ]
+        for blocks in product(*parts):
+            src, dst = zip(*blocks)
+            out[dst] = self._buffer[src]
         return out
+
+    def _update(self, low: np.ndarray, high: np.ndarray):
+        # Generate window cells [low, high) and write them to the ring buffer
+        if np.any(high <= low):
+            return
+        index = tuple(map(
+            lambda o, lo, hi, s: slice((o + lo) * s, (o + hi) * s, s),
+            self._origin, low, high, self._step
+        ))
+        ring_index = np.ix_(*map(
+            lambda head, lo, hi, n: (head + np.arange(lo, hi)) % n,
+            self._head, low, high, self._shape
+        ))
+        self._buffer[ring_index] = self.noise.generate(np.mgrid[index], repeat=self.repeat)
+
+    def shift(self, delta: Union[TYPE_SIZE, int]) -> None:
+        # Only update the ring buffer, read it by `buffer` & `head` or copy it by `frame`
+        delta = self.noise._per_dim(delta).astype(int)
+        self._origin = self._origin + delta
+        if np.any(np.abs(delta) >= self._shape):
+            # No overlap, generate the whole window
+            self._head = np.zeros(self.noise.dim, int)
+            self._update(np.zeros(self.noise.dim, int), self._shape)
+            return
+        self._head = (self._head + delta) % self._shape
+        # Cells kept from the last window
+        kept_low = np.where(delta < 0, -delta, 0)
+        kept_high = np.where(delta > 0, self._shape - delta, self._shape)
+        # Newly exposed slab of each axis, without overlapping previous axes
+        for axis in np.flatnonzero(delta):
+            low = np.where(np.arange(self.noise.dim) < axis, kept_low, 0)
+            high = np.where(np.arange(self.noise.dim) < axis, kept_high, self._shape)
+            low[axis], high[axis] = (kept_high[axis], self._shape[axis]) if delta[axis] > 0 \
+                else (0, kept_low[axis])
+            self._update(low, high)
+
+    def move_to(self, origin: TYPE_SIZE) -> None:
+        self.shift(np.array(origin, int) - self._origin)
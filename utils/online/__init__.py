@@ -1,4 +1,5 @@
 from ..logger import logger
+from .http import Response, HTTPConnectionPool, AsyncHTTPConnectionPool
 
 try:
     from .aliyun import AcsToken, AcsTokenData, AcsAccess
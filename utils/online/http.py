@@ -0,0 +1,276 @@
+import asyncio
+import http.client
+import ssl
+import threading
+import time
+from collections import defaultdict
+from io import BytesIO
+from typing import Any, Dict, List, NamedTuple, Tuple, Union
+from urllib.parse import urlsplit
+
+from ..const import HTTP
+from ..logger import logger
+
+POOL_SIZE = HTTP.POOL_SIZE
+IDLE_TIMEOUT = HTTP.IDLE_TIMEOUT
+TIMEOUT = HTTP.TIMEOUT
+
+TYPE_KEY = Tuple[str, str, int]
+TYPE_BODY = Union[str, bytes, None]
+
+
+class Response(NamedTuple):
+    status: int
+    headers: http.client.HTTPMessage
+    body: bytes
+
+
+def _split(url: str) -> Tuple[TYPE_KEY, str]:
+    """Split an url into (scheme, host, port) and the path."""
+    parts = urlsplit(url)
+    port = parts.port or (443 if parts.scheme == 'https' else 80)
+    path = parts.path or '/'
+    if parts.query:
+        path += f'?{parts.query}'
+    return (parts.scheme, parts.hostname, port), path
+
+
+class _ConnectionPool(object):
+    _idle: Dict[TYPE_KEY, List[Tuple[Any, float]]]
+
+    def __init__(self, size: int = POOL_SIZE, idle_timeout: float = IDLE_TIMEOUT, timeout: float = TIMEOUT):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        # Idle connections of each host, the last one is the most recently used
+        self._idle = defaultdict(list)
+        self.stats = {
+            'requests': 0, 'created': 0, 'reused': 0, 'retried': 0, 'reaped': 0,
+            'latency': 0., 'latency_max': 0.
+        }
+
+    @staticmethod
+    def _close(connection) -> None:
+        raise NotImplementedError
+
+    def _reap(self, key: TYPE_KEY, now: float) -> None:
+        idle = self._idle[key]
+        while idle and now - idle[0][1] >= self.idle_timeout:
+            self._close(idle.pop(0)[0])
+            self.stats['reaped'] += 1
+
+    def _pop(self, key: TYPE_KEY):
+        self._reap(key, time.monotonic())
+        if self._idle[key]:
+            self.stats['reused'] += 1
+            return self._idle[key].pop()[0]
+        return None
+
+    def _push(self, key: TYPE_KEY, connection) -> None:
+        self._idle[key].append((connection, time.monotonic()))
+
+    def _record(self, key: TYPE_KEY, start: float) -> None:
+        latency = time.monotonic() - start
+        self.stats['requests'] += 1
+        self.stats['latency'] += latency
+        self.stats['latency_max'] = max(self.stats['latency_max'], latency)
+        logger.debug(f'HTTP request to {key[1]}:{key[2]} finished in {latency:.3f}s.')
+
+    def reap(self) -> None:
+        """Close connections idle for too long."""
+        now = time.monotonic()
+        for key in list(self._idle):
+            self._reap(key, now)
+
+    @property
+    def idle(self) -> int:
+        return sum(len(_) for _ in self._idle.values())
+
+
+class HTTPConnectionPool(_ConnectionPool):
+    """Keep-alive HTTP(S) connections (http.client), at most `size` in use per host."""
+
+    def __init__(self, size: int = POOL_SIZE, idle_timeout: float = IDLE_TIMEOUT, timeout: float = TIMEOUT):
+        super().__init__(size, idle_timeout, timeout)
+        self._lock = threading.Lock()
+        self._slots = defaultdict(lambda: threading.BoundedSemaphore(self.size))
+
+    @staticmethod
+    def _close(connection: http.client.HTTPConnection) -> None:
+        connection.close()
+
+    def _connect(self, key: TYPE_KEY) -> http.client.HTTPConnection:
+        scheme, host, port = key
+        with self._lock:
+            self.stats['created'] += 1
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, port, timeout=self.timeout)
+        return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+    @staticmethod
+    def _send(connection: http.client.HTTPConnection,
+              method: str, path: str, body: TYPE_BODY, headers: dict) -> http.client.HTTPResponse:
+        connection.request(method, path, body=body, headers=headers)
+        response = connection.getresponse()
+        response.data = response.read()
+        return response
+
+    def request(self, method: str, url: str, body: TYPE_BODY = None, headers: dict = None) -> Response:
+        """Send a request with a pooled connection."""
+        key, path = _split(url)
+        headers = headers if headers else {}
+        with self._lock:
+            slot = self._slots[key]
+        with slot:
+            start = time.monotonic()
+            with self._lock:
+                connection = self._pop(key)
+            reused = connection is not None
+            if not reused:
+                connection = self._connect(key)
+            try:
+                try:
+                    response = self._send(connection, method, path, body, headers)
+                except (ConnectionError, http.client.BadStatusLine):
+                    if not reused:
+                        raise
+                    # The server closed the idle connection, retry with a new one
+                    connection.close()
+                    with self._lock:
+                        self.stats['retried'] += 1
+                    connection = self._connect(key)
+                    response = self._send(connection, method, path, body, headers)
+            except BaseException:
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                with self._lock:
+                    self._push(key, connection)
+            with self._lock:
+                self._record(key, start)
+        return Response(response.status, response.msg, response.data)
+
+    def reap(self) -> None:
+        with self._lock:
+            super().reap()
+
+    def close(self) -> None:
+        """Close all idle connections."""
+        with self._lock:
+            for idle in self._idle.values():
+                for connection, _ in idle:
+                    connection.close()
+            self._idle.clear()
+
+
+class AsyncHTTPConnectionPool(_ConnectionPool):
+    """Keep-alive HTTP(S) connections (asyncio streams), at most `size` in use per host."""
+
+    def __init__(self, size: int = POOL_SIZE, idle_timeout: float = IDLE_TIMEOUT, timeout: float = TIMEOUT):
+        super().__init__(size, idle_timeout, timeout)
+        self._slots = defaultdict(lambda: asyncio.Semaphore(self.size))
+        self._ssl = None
+
+    @staticmethod
+    def _close(connection: Tuple[asyncio.StreamReader, asyncio.StreamWriter]) -> None:
+        connection[1].close()
+
+    async def _connect(self, key: TYPE_KEY) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        scheme, host, port = key
+        if scheme == 'https' and self._ssl is None:
+            self._ssl = ssl.create_default_context()
+        self.stats['created'] += 1
+        return await asyncio.open_connection(host, port, ssl=self._ssl if scheme == 'https' else None)
+
+    @staticmethod
+    async def _read_body(reader: asyncio.StreamReader, headers: http.client.HTTPMessage) -> Tuple[bytes, bool]:
+        """Read the body, return it and if the connection can not be reused."""
+        if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if not size:
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            # Trailers
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            return b''.join(chunks), False
+        length = headers.get('Content-Length')
+        if length is not None:
+            return await reader.readexactly(int(length)), False
+        return await reader.read(), True
+
+    async def _send(self, connection: Tuple[asyncio.StreamReader, asyncio.StreamWriter], key: TYPE_KEY,
+                    method: str, path: str, body: TYPE_BODY, headers: dict) -> Tuple[Response, bool]:
+        reader, writer = connection
+        if isinstance(body, str):
+            body = body.encode()
+        scheme, host, port = key
+        lines = [f'{method} {path} HTTP/1.1', f'Host: {host}' if port in (80, 443) else f'Host: {host}:{port}']
+        lines += [f'{name}: {value}' for name, value in headers.items()]
+        if body is not None:
+            lines.append(f'Content-Length: {len(body)}')
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (body if body else b''))
+        await writer.drain()
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError('Remote end closed connection without response.')
+        version, status = status_line.split(None, 2)[:2]
+        header_lines = []
+        while True:
+            line = await reader.readline()
+            header_lines.append(line)
+            if line in (b'\r\n', b'\n', b''):
+                break
+        response_headers = http.client.parse_headers(BytesIO(b''.join(header_lines)))
+        response_body, will_close = await self._read_body(reader, response_headers)
+        will_close = will_close or version == b'HTTP/1.0' or \
+            'close' in response_headers.get('Connection', '').lower()
+        return Response(int(status), response_headers, response_body), will_close
+
+    async def request(self, method: str, url: str, body: TYPE_BODY = None, headers: dict = None) -> Response:
+        """Send a request with a pooled connection."""
+        key, path = _split(url)
+        headers = headers if headers else {}
+        async with self._slots[key]:
+            start = time.monotonic()
+            connection = self._pop(key)
+            reused = connection is not None
+            try:
+                if not reused:
+                    connection = await asyncio.wait_for(self._connect(key), self.timeout)
+                try:
+                    response, will_close = await asyncio.wait_for(
+                        self._send(connection, key, method, path, body, headers), self.timeout
+                    )
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    if not reused:
+                        raise
+                    # The server closed the idle connection, retry with a new one
+                    self._close(connection)
+                    self.stats['retried'] += 1
+                    connection = await asyncio.wait_for(self._connect(key), self.timeout)
+                    response, will_close = await asyncio.wait_for(
+                        self._send(connection, key, method, path, body, headers), self.timeout
+                    )
+            except BaseException:
+                if connection is not None:
+                    self._close(connection)
+                raise
+            if will_close:
+                self._close(connection)
+            else:
+                self._push(key, connection)
+            self._record(key, start)
+        return response
+
+    def close(self) -> None:
+        """Close all idle connections."""
+        for idle in self._idle.values():
+            for connection, _ in idle:
+                self._close(connection)
+        self._idle.clear()
@@ -1,11 +1,17 @@
+import asyncio
+import codecs
 import os
 import re
+import selectors
 import shlex
 import signal
 import subprocess
 import time
-from pathlib import Path
-from typing import IO
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Deque, Dict, List, Optional, Set, Tuple
+from uuid import uuid4
 
 from .config import shell as config
 from .logger import logger
@@ -13,8 +19,73 @@ from .time import get_str_time
 
 TIMEOUT = config.timeout
 SHELL_EXEC = config.shell_exec
-CHECK_DIR = config.check_dir
 REPLACE = config.output_replace
+STREAM_INTERVAL = config.stream_interval
+STREAM_SIZE = config.stream_size
+STREAM_LIMIT = config.stream_limit
+WORKERS = config.workers
+GROUP_QUEUE = config.group_queue
+MEMBER_QUEUE = config.member_queue
+OUTPUT_LIMIT = config.output_limit
+POOL_SIZE = config.pool_size
+POOL_RECYCLE = config.pool_recycle
+SESSION_TTL = config.session_ttl
+SESSION_LIMIT = config.session_limit
+# Chunk size when reading pipes
+READ_SIZE = 65536
+# Resource limits set (both soft and hard) in the shell before running commands
+LIMITS = '; '.join(f'ulimit -{flag} {value}' for flag, value in (
+    ('t', config.limit_cpu),
+    ('v', config.limit_memory * 1024),
+    ('n', config.limit_files),
+    ('f', config.limit_output * 1024)
+) if value)
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+
+
+class OutputCapture(object):
+    """Keep the head and the tail (ring) of an output within a byte limit."""
+
+    def __init__(self, limit: int = OUTPUT_LIMIT):
+        self.size = 0
+        self._head_size = limit - limit // 2
+        self._tail_size = limit // 2
+        self._head = bytearray()
+        self._tail = bytearray()
+
+    def feed(self, data: bytes) -> None:
+        self.size += len(data)
+        room = self._head_size - len(self._head)
+        if room > 0:
+            self._head += data[:room]
+            data = data[room:]
+        self._tail += data
+        if len(self._tail) > self._tail_size:
+            del self._tail[:len(self._tail) - self._tail_size]
+
+    @property
+    def omitted(self) -> int:
+        return self.size - len(self._head) - len(self._tail)
+
+    def getvalue(self) -> bytes:
+        if not self.omitted:
+            return bytes(self._head + self._tail)
+        # Do not start the tail in the middle of a UTF-8 character
+        start = 0
+        while start < min(3, len(self._tail)) and self._tail[start] & 0xC0 == 0x80:
+            start += 1
+        return b''.join([
+            self._head,
+            f'\n<{self.omitted + start} bytes omitted>\n'.encode(),
+            self._tail[start:]
+        ])
+
+
+def _capture(*outputs: bytes) -> bytes:
+    capture = OutputCapture()
+    for output in outputs:
+        capture.feed(output)
+    return capture.getvalue()
 
 
 class CompletedProcess(object):
@@ -22,10 +93,13 @@ class CompletedProcess(object):
     stdout: bytes
     stderr: bytes
 
-    def __init__(self, code: int, stdout: bytes, stderr: bytes):
+    usage: Dict[str, float]
+
+    def __init__(self, code: int, stdout: bytes, stderr: bytes, usage: Dict[str, float] = None):
         self.code = code
         self.stdout = stdout
         self.stderr = stderr
+        self.usage = usage if usage else {}
 
     @classmethod
     def from_subprocess(cls, process: subprocess.CompletedProcess):
@@ -33,20 +107,16 @@ class CompletedProcess(object):
 
     @staticmethod
     def bytes_decode(input_bytes: bytes) -> str:
-        try:
-            return input_bytes.decode()
-        except UnicodeDecodeError:
-            return '<BIN>'
+        return input_bytes.decode(errors='replace')
 
     def as_string(self) -> str:
-        output = '{}{}{}'.format(
-            f'Return code: {self.code}\n',
+        output = '{}{}{}{}'.format(
+            f'Return code: {self.code}',
+            f', CPU: {self.usage["cpu"]:.3f}s\n' if 'cpu' in self.usage else '\n',
             f'\nSTDOUT: \n{self.bytes_decode(self.stdout)}' if self.stdout else '',
             f'\nSTDERR: \n{self.bytes_decode(self.stderr)}' if self.stderr else ''
         )[:-1]
-        for item in REPLACE.items():
-            output = output.replace(item[0], item[1])
-        return output
+        return _replace(output)
 
     def __str__(self) -> str:
         return self.as_string()
@@ -71,15 +141,90 @@ def cmd_analyze(command: str) -> str:
     return command
 
 
-def _read_file(f: IO, tag: str) -> bytes:
-    """Read IO not ended by EOF."""
-    out_str = b''
-    out_line = f.readline()
-    tag = tag.encode()
-    while tag not in out_line:
-        out_str += out_line
-        out_line = f.readline()
-    return out_str
+async def _read_until(stream: asyncio.StreamReader, tag: bytes) -> Tuple[bytes, bytes]:
+    """Read a pipe until the tag line, return (captured) output and the rest of the tag line."""
+    capture = OutputCapture()
+    buffer = bytearray()
+    while True:
+        index = buffer.find(tag)
+        if index >= 0:
+            end = buffer.find(b'\n', index)
+            if end >= 0:
+                capture.feed(buffer[:index])
+                return capture.getvalue(), bytes(buffer[index + len(tag):end])
+        elif len(buffer) >= len(tag):
+            # Only keep what may be the beginning of the tag
+            capture.feed(buffer[:1 - len(tag)])
+            del buffer[:1 - len(tag)]
+        chunk = await stream.read(READ_SIZE)
+        if not chunk:
+            raise EOFError('Shell terminated.')
+        buffer += chunk
+
+
+def _limited(command: str) -> str:
+    return f'{LIMITS}\n{command}' if LIMITS else command
+
+
+def _proc_stat(pid) -> List[bytes]:
+    """Read fields of /proc/<pid>/stat after the process name."""
+    try:
+        with open(f'/proc/{pid}/stat', 'rb') as f:
+            stat = f.read()
+    except OSError:
+        return []
+    return stat[stat.rfind(b')') + 2:].split()
+
+
+def _children_cpu(pid: int) -> float:
+    """CPU time of waited children of a process."""
+    fields = _proc_stat(pid)
+    return (int(fields[13]) + int(fields[14])) / CLK_TCK if fields else 0.
+
+
+def _kill(pid: int, group: bool = False) -> None:
+    try:
+        (os.killpg if group else os.kill)(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def _kill_session(sid: int) -> None:
+    """Kill all processes in a session except its leader."""
+    groups = set()
+    for entry in os.scandir('/proc'):
+        if not entry.name.isdigit() or int(entry.name) == sid:
+            continue
+        fields = _proc_stat(entry.name)
+        if len(fields) > 3 and int(fields[3]) == sid:
+            if int(fields[2]) == sid:
+                _kill(int(entry.name))
+            else:
+                groups.add(int(fields[2]))
+    for pgid in groups:
+        _kill(pgid, True)
+
+
+def _communicate(process: subprocess.Popen, timeout: float) -> Tuple[bytes, bytes, bool]:
+    """Read stdout & stderr into captures until EOF, return outputs and if timeout is reached."""
+    captures = {process.stdout: OutputCapture(), process.stderr: OutputCapture()}
+    deadline = time.monotonic() + timeout
+    timed_out = False
+    with selectors.DefaultSelector() as selector:
+        for pipe in captures:
+            selector.register(pipe, selectors.EVENT_READ)
+        while selector.get_map():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                timed_out = True
+                break
+            for key, _ in selector.select(remaining):
+                chunk = os.read(key.fd, READ_SIZE)
+                if chunk:
+                    captures[key.fileobj].feed(chunk)
+                else:
+                    selector.unregister(key.fileobj)
+    return captures[process.stdout].getvalue(), captures[process.stderr].getvalue(), timed_out
 
 
 def single_cmd(command: str) -> CompletedProcess:
@@ -87,132 +232,406 @@ def single_cmd(command: str) -> CompletedProcess:
     command = cmd_analyze(command)
     if not command:
         return CompletedProcess(132, b'', b'Command check failed!')
-    try:
-        return CompletedProcess.from_subprocess(subprocess.run(
-            shlex.join(SHELL_EXEC + ['-c', command]),
-            capture_output=True,
+    with subprocess.Popen(
+            shlex.join(SHELL_EXEC + ['-c', _limited(command)]),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
             shell=True,
-            timeout=TIMEOUT
-        ))
-    except subprocess.TimeoutExpired as e:
-        return CompletedProcess(137, e.stdout, e.stderr)
+            start_new_session=True
+    ) as process:
+        stdout, stderr, timed_out = _communicate(process, TIMEOUT)
+        if timed_out:
+            _kill(process.pid, True)
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        # No max RSS: a forked child starts with the RSS of the bot
+        usage = {'cpu': rusage.ru_utime + rusage.ru_stime}
+        return CompletedProcess(137 if timed_out else process.returncode, stdout, stderr, usage)
+
+
+# Replace all items in one pass, longer keys first
+_REPLACE_PATTERN = re.compile('|'.join(map(re.escape, sorted(REPLACE, key=len, reverse=True)))) if REPLACE else None
+# Characters kept back while streaming, so no key is split between pieces
+_REPLACE_HOLD = max(map(len, REPLACE)) - 1 if REPLACE else 0
+
+
+def _replace(text: str) -> str:
+    if _REPLACE_PATTERN is None:
+        return text
+    return _REPLACE_PATTERN.sub(lambda match: REPLACE[match.group()], text)
+
+
+def _cut(buffer: str, size: int) -> int:
+    """Move the end of a piece after the key it splits."""
+    if _REPLACE_PATTERN is not None:
+        for match in _REPLACE_PATTERN.finditer(buffer, 0, size + _REPLACE_HOLD):
+            if match.start() >= size:
+                break
+            if match.end() > size:
+                return match.end()
+    return size
+
+
+def _read_close(fd: int) -> bytes:
+    """Read what is in a pipe without waiting for its writers, then close it."""
+    os.set_blocking(fd, False)
+    try:
+        return os.read(fd, READ_SIZE)
+    except BlockingIOError:
+        return b''
+    finally:
+        os.close(fd)
+
+
+def _times_cpu(output: bytes) -> Optional[float]:
+    """Sum the CPU time (shell & children, user & system) printed by the `times` builtin."""
+    values = re.findall(rb'(\d+)m(\d+)[.,](\d+)s', output)
+    if len(values) != 4:
+        return None
+    return sum(int(m) * 60 + float(f'{s.decode()}.{f.decode()}') for m, s, f in values)
+
+
+async def stream_cmd(command: str) -> AsyncIterator[str]:
+    """Run single command, yield output (stdout & stderr) pieces while running."""
+    command = cmd_analyze(command)
+    if not command:
+        yield 'Return code: 132\nCommand check failed!'
+        return
+    # The shell reports its CPU usage to a pipe on exit, not mixed into the output
+    usage_read, usage_write = os.pipe()
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *SHELL_EXEC, '-c', _limited(f"trap 'times >&{usage_write}' EXIT\n{command}"),
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            start_new_session=True,
+            pass_fds=(usage_write,)
+        )
+    except BaseException:
+        os.close(usage_read)
+        raise
+    finally:
+        os.close(usage_write)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + TIMEOUT
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    # Flush by size or interval, stop sending (but keep draining) after the limit
+    buffer, sent, last_flush = '', 0, loop.time()
+    code, eof = None, False
+    try:
+        while not eof:
+            now = loop.time()
+            if now >= deadline:
+                logger.warning('Reached timeout, kill the process.')
+                _kill(process.pid, True)
+                code = 137
+                # Flush what was read before the kill
+                chunk, eof = b'', True
+            else:
+                try:
+                    chunk = await asyncio.wait_for(
+                        process.stdout.read(READ_SIZE),
+                        min(deadline, last_flush + STREAM_INTERVAL) - now
+                    )
+                    eof = not chunk
+                except asyncio.TimeoutError:
+                    chunk = b''
+                    if len(buffer) <= _REPLACE_HOLD:
+                        last_flush = loop.time()
+            if sent < STREAM_LIMIT:
+                buffer += decoder.decode(chunk, final=eof)
+            hold = 0 if eof else _REPLACE_HOLD
+            while len(buffer) > hold and (
+                    eof or len(buffer) >= STREAM_SIZE + hold or loop.time() - last_flush >= STREAM_INTERVAL):
+                size = _cut(buffer, min(STREAM_SIZE, STREAM_LIMIT - sent, len(buffer) - hold))
+                output, buffer = buffer[:size], buffer[size:]
+                sent += len(output)
+                last_flush = loop.time()
+                yield _replace(output)
+                if sent >= STREAM_LIMIT:
+                    buffer = ''
+                    yield f'<Output exceeds {STREAM_LIMIT} characters, truncated>'
+    finally:
+        try:
+            if process.returncode is None and not eof:
+                # Generator closed early
+                _kill(process.pid, True)
+            elif code is None:
+                try:
+                    # Output closed, but the process may keep running
+                    await asyncio.wait_for(process.wait(), max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    logger.warning('Reached timeout, kill the process.')
+                    _kill(process.pid, True)
+                    code = 137
+            returncode = await process.wait()
+        finally:
+            times = _read_close(usage_read)
+    cpu = _times_cpu(times)
+    yield f'Return code: {returncode if code is None else code}' + (f', CPU: {cpu:.3f}s' if cpu is not None else '')
+
+
+class QueueFullError(RuntimeError):
+    pass
+
+
+class SessionLimitError(RuntimeError):
+    pass
+
+
+class Scheduler(object):
+    """Run commands with a global cap, serve queued groups and members in turn."""
+    _queues: Dict[int, Dict[int, Deque[asyncio.Future]]]
+
+    def __init__(self, workers: int = WORKERS, group_queue: int = GROUP_QUEUE, member_queue: int = MEMBER_QUEUE):
+        self.workers = workers
+        self.group_queue = group_queue
+        self.member_queue = member_queue
+        self._running = 0
+        # group -> member -> waiting jobs, both levels rotated after each pick
+        self._queues = OrderedDict()
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='shell')
+        self.stats = {'done': 0, 'rejected': 0, 'wait': 0., 'wait_max': 0., 'run': 0., 'run_max': 0.}
+
+    def queued(self, group: int = None, member: int = None) -> int:
+        """Count waiting jobs of a member, a group or all."""
+        if group is None:
+            return sum(self.queued(_) for _ in self._queues)
+        members = self._queues.get(group, {})
+        if member is None:
+            return sum(len(_) for _ in members.values())
+        return len(members.get(member, ()))
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    def _dispatch(self) -> None:
+        while self._running < self.workers and self._queues:
+            group, members = next(iter(self._queues.items()))
+            member, jobs = next(iter(members.items()))
+            future = jobs.popleft()
+            if jobs:
+                members.move_to_end(member)
+            else:
+                del members[member]
+            if members:
+                self._queues.move_to_end(group)
+            else:
+                del self._queues[group]
+            if not future.done():
+                self._running += 1
+                future.set_result(None)
+
+    def _remove(self, group: int, member: int, future: asyncio.Future) -> None:
+        members = self._queues.get(group, {})
+        jobs = members.get(member, deque())
+        if future in jobs:
+            jobs.remove(future)
+            if not jobs:
+                del members[member]
+            if not members:
+                del self._queues[group]
+
+    @asynccontextmanager
+    async def slot(self, group: int, member: int):
+        """Wait for a free slot, raise QueueFullError if too many jobs are waiting."""
+        if self.queued(group, member) >= self.member_queue or self.queued(group) >= self.group_queue:
+            self.stats['rejected'] += 1
+            raise QueueFullError(f'Too many queued commands: group {group}, member {member}.')
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queues.setdefault(group, OrderedDict()).setdefault(member, deque()).append(future)
+        queued = loop.time()
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                self._remove(group, member, future)
+            else:
+                # Slot granted right before cancelled
+                self._running -= 1
+                self._dispatch()
+            raise
+        start = loop.time()
+        try:
+            yield
+        finally:
+            self._running -= 1
+            wait, run = start - queued, loop.time() - start
+            self.stats['done'] += 1
+            self.stats['wait'] += wait
+            self.stats['wait_max'] = max(self.stats['wait_max'], wait)
+            self.stats['run'] += run
+            self.stats['run_max'] = max(self.stats['run_max'], run)
+            logger.debug(f'Shell job of {group}/{member}: waited {wait:.3f}s, ran {run:.3f}s.')
+            self._dispatch()
+
+    async def run(self, group: int, member: int, func: Callable, *args):
+        """Run a function (blocking ones in the scheduler's own threads) within a slot."""
+        async with self.slot(group, member):
+            if asyncio.iscoroutinefunction(func):
+                return await func(*args)
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+
+scheduler = Scheduler()
 
 
 class Shell(object):
-    """Define an interactive shell."""
+    """Define an interactive shell (asyncio subprocess)."""
     _name: str
     _enabled: bool = False
-    _process: subprocess.Popen
+    _process: asyncio.subprocess.Process
 
     def __init__(self, name: str = None):
         self._name = name if name else get_str_time(False)
+        self._lock = asyncio.Lock()
 
     def _check_point(self) -> str:
-        """Generate check points for each command."""
-        return f'{self._name}-{get_str_time(True)}'
-
-    def _output(self, check_point: str = None) -> CompletedProcess:
-        """Get output."""
-        if not check_point:
-            check_point = self._check_point()
-        check_path = Path(CHECK_DIR, check_point)
-        if check_path.is_file():
-            return_code = int(check_path.read_text())
-        else:
-            return_code = None
-            self._process.stdin.write(f'echo $? >/dev/stderr\n'.encode())
+        """Generate sentinel markers for each command."""
+        return f'{self._name}-{uuid4().hex}'
+
+    async def _run(self, command: str, timeout: float) -> CompletedProcess:
+        """Run a command, wait for markers on stdout & stderr."""
+        cpu = _children_cpu(self._process.pid)
+        check_point = self._check_point()
+        tag = check_point.encode()
+        # Quoted for eval: unbalanced quotes fail (code 2) instead of eating the markers,
+        # no stdin for the command, so it never reads the markers either
         self._process.stdin.write(
-            f'echo {check_point} >/dev/stdout\n'
-            f'echo {check_point} >/dev/stderr\n'.encode()
+            f'eval {shlex.quote(command)} </dev/null\n'
+            f'echo "{check_point}" $?\n'
+            f'echo "{check_point}" >&2\n'.encode()
         )
+        reading = asyncio.ensure_future(asyncio.gather(
+            _read_until(self._process.stdout, tag),
+            _read_until(self._process.stderr, tag)
+        ))
         try:
-            self._process.stdin.flush()
-        except BrokenPipeError:
+            await self._process.stdin.drain()
+            (stdout, code), (stderr, _) = await asyncio.wait_for(asyncio.shield(reading), max(timeout, 0))
+        except asyncio.TimeoutError:
+            logger.warning('Reached timeout, kill the process.')
+            await self.kill()
+            try:
+                (stdout, code), (stderr, _) = await asyncio.wait_for(reading, TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning('Shell not responding, terminate it.')
+                await self._terminate()
+                return CompletedProcess(137, b'', b'Shell terminated.')
+        except (EOFError, BrokenPipeError, ConnectionResetError):
+            reading.cancel()
             logger.warning('Shell terminated.')
-            self._enabled = False
+            await self._terminate()
             return CompletedProcess(-1, b'', b'')
-        stdout = _read_file(self._process.stdout, check_point)
-        stderr = _read_file(self._process.stderr, check_point)
-        if return_code is None:
-            err_list = stderr.split(b'\n')
-            return_code = int(err_list[-2])
-            stderr = b'\n'.join(err_list[:-2]) + b'\n'
-        return CompletedProcess(return_code, stdout, stderr)
-
-    def kill(self) -> None:
+        try:
+            code = int(code)
+        except ValueError:
+            # Marker line broken by the command output
+            logger.warning('Invalid return code, terminate the shell.')
+            await self._terminate()
+            return CompletedProcess(-1, stdout, stderr)
+        usage = {'cpu': _children_cpu(self._process.pid) - cpu}
+        return CompletedProcess(code, stdout, stderr, usage)
+
+    async def _terminate(self) -> None:
+        """Force to stop the shell."""
+        self._enabled = False
+        if self._process.returncode is None:
+            _kill_session(self._process.pid)
+            _kill(self._process.pid, True)
+        await self._process.wait()
+
+    async def kill(self) -> None:
         """Kill all processes called by current shell."""
-        for pid in subprocess.run(
-                f'ps -o pid --ppid {self._process.pid} --no-headers',
-                capture_output=True,
-                shell=True,
-        ).stdout.decode().split('\n')[:-1]:
-            os.kill(int(pid), signal.SIGKILL)
-
-    def start(self, env: dict = None) -> bool:
+        _kill_session(self._process.pid)
+
+    async def start(self, env: dict = None) -> bool:
         """Start the shell."""
         if self._enabled:
             logger.warning('The current shell is still running.')
             return False
-        self._process = subprocess.Popen(
-            SHELL_EXEC,
+        self._process = await asyncio.create_subprocess_exec(
+            *SHELL_EXEC,
             env=env if env else None,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=True
         )
-        Path(CHECK_DIR).mkdir(mode=0o777, parents=True, exist_ok=True)
-        if self._process.poll() is None:
+        if self._process.returncode is None:
+            # Job control: each command runs in its own process group
+            self._process.stdin.write(_limited('set -m').encode() + b'\n')
             self._enabled = True
             return True
         logger.error('Failed to start shell!')
         return False
 
-    def send(self, text: str) -> CompletedProcess:
+    async def send(self, text: str) -> CompletedProcess:
         """Send command(s) to the shell."""
-        timeout = TIMEOUT
-        check_point = None
-        for cmd_line in text.split('\n'):
-            command = cmd_analyze(cmd_line)
-            # Output never caught if simply called 'exit'
-            if command == 'exit':
-                return self.exit()
-            command = re.sub('exit', 'Exit', command)
-            check_point = self._check_point()
-            check_path = Path(CHECK_DIR, check_point)
-            self._process.stdin.write(
-                f'{command}\n'
-                f'echo $? >"{check_path}"\n'.encode()
-            )
-            self._process.stdin.flush()
-            while timeout > 0 and not check_path.is_file():
-                timeout -= 0.1
-                time.sleep(0.1)
-            if not timeout > 0:
-                logger.warning('Reached timeout, kill the process.')
-                self.kill()
-                return self._output(check_point)
-        if check_point is None:
+        if not self._enabled:
+            logger.warning('The current shell is not running.')
+            return CompletedProcess(2, b'', b'Shell not running.')
+        async with self._lock:
+            deadline = asyncio.get_running_loop().time() + TIMEOUT
+            outputs = []
+            for cmd_line in text.split('\n'):
+                if not cmd_line.strip():
+                    continue
+                try:
+                    command = cmd_analyze(cmd_line)
+                except ValueError as e:
+                    outputs.append(CompletedProcess(132, b'', f'{e}\n'.encode()))
+                    break
+                if not command:
+                    outputs.append(CompletedProcess(132, b'', f'Command check failed: {cmd_line}\n'.encode()))
+                    break
+                # Output never caught if simply called 'exit'
+                if command == 'exit':
+                    return await self._exit()
+                command = re.sub('exit', 'Exit', command)
+                outputs.append(await self._run(command, deadline - asyncio.get_running_loop().time()))
+                # Stop when the shell died or reached timeout
+                if not self._enabled or asyncio.get_running_loop().time() >= deadline:
+                    break
+        if not outputs:
             return CompletedProcess(2, b'', b'No command passed.')
-        return self._output(check_point)
+        return CompletedProcess(
+            outputs[-1].code,
+            _capture(*(_.stdout for _ in outputs)),
+            _capture(*(_.stderr for _ in outputs)),
+            {'cpu': sum(_.usage.get('cpu', 0.) for _ in outputs)}
+        )
+
+    async def run(self, command: str, timeout: float = TIMEOUT) -> CompletedProcess:
+        """Run a (multi-line) command as a whole, without checking or splitting."""
+        if not self._enabled:
+            logger.warning('The current shell is not running.')
+            return CompletedProcess(2, b'', b'Shell not running.')
+        async with self._lock:
+            return await self._run(command, timeout)
 
-    def exit(self) -> CompletedProcess:
+    async def exit(self) -> CompletedProcess:
         """Gracefully close the shell."""
+        async with self._lock:
+            return await self._exit()
+
+    async def _exit(self) -> CompletedProcess:
         if not self._enabled:
             logger.warning('The current shell is not running.')
             return CompletedProcess(2, b'', b'')
+        self._enabled = False
         try:
-            stdout, stderr = self._process.communicate(
-                f'touch "{CHECK_DIR}/{self._name}-exit"\n'
-                f'rm "{CHECK_DIR}/{self._name}"*\n'
-                'exit\n'.encode(),
-                timeout=TIMEOUT
-            )
-        except subprocess.TimeoutExpired:
-            self._process.terminate()
-            stdout, stderr = '', 'Shell terminated.'
+            stdout, stderr = await asyncio.wait_for(self._process.communicate(b'exit\n'), TIMEOUT)
+        except asyncio.TimeoutError:
+            await self._terminate()
+            stdout, stderr = b'', b'Shell terminated.'
         if self._process.returncode != 0:
             logger.warning(f'Shell return code: {self._process.returncode}')
-        self._enabled = False
         return CompletedProcess(self._process.returncode, stdout, stderr)
 
     @property
@@ -223,7 +642,209 @@ class Shell(object):
     @property
     def enabled(self) -> bool:
         """Check if the shell is running."""
-        return self._enabled
+        return self._enabled and self._process.returncode is None
+
+    @property
+    def busy(self) -> bool:
+        """Check if the shell is running commands."""
+        return self._lock.locked()
+
+    async def ping(self, timeout: float = 1.) -> bool:
+        """Check if the shell answers a marker round-trip."""
+        if not self.enabled:
+            return False
+        return (await self.run(':', timeout)).code == 0
+
+
+class ShellPool(object):
+    """
+    Keep started shells warm to run single commands without spawning new shells.
+    Call start() on startup, shells are checked by a marker round-trip before each use
+    """
+    _idle: asyncio.Queue
+    _retiring: Set[asyncio.Task]
+
+    def __init__(self, size: int = POOL_SIZE, recycle: int = POOL_RECYCLE):
+        self.size = size
+        self.recycle = recycle
+        self._uses = {}
+        self._started = False
+        self._count = 0
+        self._retiring = set()
+
+    async def _spawn(self) -> Shell:
+        self._count += 1
+        shell = Shell(f'pool-{self._count}')
+        await shell.start()
+        self._uses[shell] = 0
+        return shell
+
+    async def _drop(self, shell: Shell) -> None:
+        self._uses.pop(shell, None)
+        if shell.enabled:
+            await shell.exit()
+
+    async def _retire(self, shell: Shell) -> None:
+        """Close a shell, put a new one into the pool."""
+        await self._drop(shell)
+        self._idle.put_nowait(await self._spawn())
+
+    def _retired(self, task: asyncio.Task) -> None:
+        self._retiring.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f'Failed to replace a pooled shell: {task.exception()!r}')
+
+    async def start(self) -> None:
+        """Start all shells of the pool."""
+        if self._started:
+            return
+        self._started = True
+        self._idle = asyncio.Queue()
+        for shell in await asyncio.gather(*(self._spawn() for _ in range(self.size))):
+            self._idle.put_nowait(shell)
+
+    async def _acquire(self) -> Shell:
+        shell = await self._idle.get()
+        if not await shell.ping():
+            logger.warning(f'Shell {shell.name} is not responding, replace it.')
+            await self._drop(shell)
+            shell = await self._spawn()
+        return shell
+
+    def _release(self, shell: Shell, process: CompletedProcess = None) -> None:
+        self._uses[shell] += 1
+        if process is None or process.code in (-1, 137) or self._uses[shell] >= self.recycle or not shell.enabled:
+            task = asyncio.ensure_future(self._retire(shell))
+            self._retiring.add(task)
+            task.add_done_callback(self._retired)
+        else:
+            self._idle.put_nowait(shell)
+
+    async def run(self, command: str) -> CompletedProcess:
+        """Run single command in an idle shell."""
+        try:
+            command = cmd_analyze(command)
+        except ValueError as e:
+            return CompletedProcess(132, b'', f'{e}\n'.encode())
+        if not command:
+            return CompletedProcess(132, b'', b'Command check failed!\n')
+        await self.start()
+        shell = await self._acquire()
+        process = None
+        try:
+            # Subshell keeps the worker clean (cwd, env, exit), quoted so the command stays data
+            process = await shell.run(f'(eval {shlex.quote(command)}) </dev/null')
+            return process
+        finally:
+            self._release(shell, process)
+
+    async def close(self) -> None:
+        """Wait for replacing shells, close all idle shells."""
+        if not self._started:
+            return
+        if self._retiring:
+            await asyncio.gather(*self._retiring, return_exceptions=True)
+        while not self._idle.empty():
+            shell = self._idle.get_nowait()
+            self._uses.pop(shell, None)
+            await shell.exit()
+        self._started = False
+
+    @property
+    def idle(self) -> int:
+        return self._idle.qsize() if self._started else 0
+
+
+pool = ShellPool()
+
+
+class SessionManager(object):
+    """Keep one interactive shell per (group, member), close idle ones after TTL."""
+    _sessions: Dict[Tuple[int, int], Shell]
+    _reaper: asyncio.Task = None
+
+    def __init__(self, ttl: float = SESSION_TTL, limit: int = SESSION_LIMIT):
+        self.ttl = ttl
+        self.limit = limit
+        self._sessions = OrderedDict()
+        self._active = {}
+
+    def __contains__(self, key: Tuple[int, int]) -> bool:
+        return key in self._sessions and self._sessions[key].enabled
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def _touch(self, key: Tuple[int, int]) -> None:
+        self._sessions.move_to_end(key)
+        self._active[key] = asyncio.get_running_loop().time()
+
+    async def open(self, group: int, member: int, env: dict = None) -> Shell:
+        """Get the shell of a member, start a new one if needed."""
+        key = (group, member)
+        if key in self:
+            self._touch(key)
+            return self._sessions[key]
+        await self.close(group, member)
+        if len(self._sessions) >= self.limit:
+            await self._reap()
+        if len(self._sessions) >= self.limit:
+            raise SessionLimitError(f'Too many shell sessions: {len(self._sessions)}.')
+        shell = Shell(f'{group}-{member}')
+        if not await shell.start(dict(os.environ, **env) if env else None):
+            raise RuntimeError('Failed to start shell!')
+        self._sessions[key] = shell
+        self._touch(key)
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.ensure_future(self._reap_forever())
+        return shell
+
+    async def send(self, group: int, member: int, text: str) -> CompletedProcess:
+        """Send command(s) to the shell of a member."""
+        key = (group, member)
+        if key not in self:
+            await self.close(group, member)
+            return CompletedProcess(2, b'', b'Shell not running.')
+        self._touch(key)
+        process = await self._sessions[key].send(text)
+        if key in self:
+            self._touch(key)
+        else:
+            await self.close(group, member)
+        return process
+
+    async def close(self, group: int, member: int) -> CompletedProcess:
+        """Close the shell of a member."""
+        key = (group, member)
+        self._active.pop(key, None)
+        shell = self._sessions.pop(key, None)
+        if shell is None:
+            return CompletedProcess(2, b'', b'')
+        if shell.enabled:
+            return await shell.exit()
+        return CompletedProcess(0, b'', b'')
+
+    async def _reap(self) -> None:
+        now = asyncio.get_running_loop().time()
+        for key, shell in list(self._sessions.items()):
+            if not shell.enabled or not shell.busy and now - self._active[key] >= self.ttl:
+                logger.info(f'Close idle shell session {shell.name}.')
+                await self.close(*key)
+
+    async def _reap_forever(self) -> None:
+        while self._sessions:
+            await asyncio.sleep(min(self.ttl, 60))
+            await self._reap()
+
+    async def close_all(self) -> None:
+        """Close all shells."""
+        for key in list(self._sessions):
+            await self.close(*key)
+        if self._reaper is not None:
+            self._reaper.cancel()
+
+
+sessions = SessionManager()
 
 
 if __name__ == '__main__':
@@ -236,10 +857,13 @@ if __name__ == '__main__':
         print(single_cmd(user_str))
     print('[Test 1] Exit.')
     print('[Test 2] Interactive shell')
-    shell = Shell('FQi-Test')
-    shell.start()
-    while shell.enabled:
-        user_str = input('[Test 2] > ')
-        print(shell.send(user_str))
+
+    async def _test_shell():
+        shell = Shell('FQi-Test')
+        await shell.start()
+        while shell.enabled:
+            print(await shell.send(input('[Test 2] > ')))
+
+    asyncio.run(_test_shell())
     print('[Test 2] Exit.')
     print('==== TEST END ====')
@@ -1,7 +1,9 @@
-from utils.file import AudioCache
+from utils.const import TTS
+from utils.file import AudioCache, MemoryCache
 
 
 class TTSCache(AudioCache):
+    memory = MemoryCache(TTS.MEMORY_LIMIT)
 
     def __init__(self, header: str = ''):
         super().__init__(no_init=True, header=header)
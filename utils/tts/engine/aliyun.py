@@ -1,13 +1,14 @@
-import http.client
 import json
 
 from utils.config import tts
-from utils.online import AcsAccess
+from utils.online import AcsAccess, HTTPConnectionPool
 from ..cache import TTSCache
 from ..engine import TTSEngine
 
 access = AcsAccess(**tts.access)
 app_key = tts.access.get('app_key', '')
+# Keep connections alive between conversions
+pool = HTTPConnectionPool()
 
 try:
     assert not access.token.expired
@@ -20,6 +21,7 @@ class AliyunTTSEngine(TTSEngine):
     online: bool = True
 
     use_default: bool = True
+    url: str = 'https://nls-gateway.cn-shanghai.aliyuncs.com/stream/v1/tts'
 
     voice: str = None
     rate: int = None
@@ -31,12 +33,9 @@ class AliyunTTSEngine(TTSEngine):
 
     @TTSCache(name)
     def convert(self, text: str, cache: bool = True) -> bytes:
-        host = 'nls-gateway.cn-shanghai.aliyuncs.com'
-        url = 'https://' + host + '/stream/v1/tts'
-        connection = http.client.HTTPSConnection(host)
-        connection.request(
+        response = pool.request(
             method='POST',
-            url=url,
+            url=self.url,
             body=json.dumps({
                 'appkey': app_key,
                 'token': access.token.id,
@@ -46,10 +45,7 @@ class AliyunTTSEngine(TTSEngine):
             }),
             headers={'Content-Type': 'application/json'}
         )
-        response = connection.getresponse()
-        body = response.read()
-        connection.close()
-        if response.getheader('Content-Type') == 'audio/mpeg':
-            return body
+        if response.headers.get('Content-Type') == 'audio/mpeg':
+            return response.body
         else:
-            raise ConnectionError(f'The POST request failed: {body}')
+            raise ConnectionError(f'The POST request failed: {response.body}')